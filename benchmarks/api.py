@@ -0,0 +1,274 @@
+"""
+API Benchmark for the Products Service
+
+Seeds the catalog with products from tests/product_factory.py, then
+sends a series of requests to every route and reports the p50/p95/p99
+latency and throughput of each. Requests go through the Flask test
+client (--target client, in-process, no network) or a real gunicorn
+server (--target gunicorn, sent from --concurrency threads).
+
+Save a run as a baseline once, then compare later runs against it. A
+route whose p95 got slower than the baseline by more than --tolerance
+fails the run with exit code 1, so it can gate a CI job:
+
+    python -m benchmarks.api --target client --save-baseline benchmarks/baseline.json
+    python -m benchmarks.api --target client --baseline benchmarks/baseline.json
+
+Baselines only compare runs on the same machine and database, so record
+the baseline on the machine that runs the comparison.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+from benchmarks.load import free_port, start_server  # noqa: E402
+from tests.product_factory import ProductFactory  # noqa: E402
+
+
+class ClientDriver:
+    """ Sends requests through the Flask test client """
+
+    concurrent = False
+
+    def __init__(self):
+        from service import app
+        app.logger.setLevel("WARNING")
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        """ Sends one request and returns its status and JSON body """
+        resp = self.client.open(path, method=method, json=body)
+        # a streamed body is only generated as it is read, which is timed too
+        resp.get_data()
+        return resp.status_code, resp.get_json(silent=True)
+
+
+class HttpDriver:
+    """ Sends requests over HTTP to a running server """
+
+    concurrent = True
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, path, body=None):
+        """ Sends one request and returns its status and JSON body """
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base_url + path, data=data, method=method)
+        req.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(req, timeout=30) as resp:
+                status, payload = resp.status, resp.read()
+        except urllib.error.HTTPError as error:
+            status, payload = error.code, error.read()
+        try:
+            return status, json.loads(payload)
+        except ValueError:
+            return status, None
+
+
+def new_product():
+    """ Returns the JSON of a fresh product with a unique SKU """
+    return ProductFactory().serialize()
+
+
+def scenarios(ids, spare_ids):
+    """
+    Returns every benchmarked route as a (name, maker) pair
+
+    ids are seeded products the scenarios may read and update, spare_ids
+    ones they may delete. Each maker takes the iteration number and returns
+    a (method, path, body) request.
+    """
+    def pick(i):
+        return ids[i % len(ids)]
+
+    def batch(i, size=100):
+        return [ids[(i * size + n) % len(ids)] for n in range(size)]
+
+    return [
+        ("index", lambda i: ("GET", "/", None)),
+        ("list_products", lambda i: ("GET", "/products", None)),
+        ("list_products_page", lambda i: ("GET", "/products?limit=50", None)),
+        ("list_products_query", lambda i: (
+            "GET", "/products?category=food&price_min=10&sort=-price&fields=name,price", None)),
+        ("list_products_stream", lambda i: ("GET", "/products?stream=1", None)),
+        ("search_products", lambda i: ("GET", "/products/search?q=test", None)),
+        ("get_products", lambda i: ("GET", "/products/{}".format(pick(i)), None)),
+        ("create_product", lambda i: ("POST", "/products", new_product())),
+        ("update_product", lambda i: (
+            "PUT", "/products/{}".format(pick(i)), dict(new_product(), id=pick(i)))),
+        ("restock_product", lambda i: ("PUT", "/products/{}?stock=50".format(pick(i)), None)),
+        ("adjust_product_stock", lambda i: (
+            "POST", "/products/{}/stock".format(pick(i)), {"delta": 1})),
+        ("adjust_products_stock", lambda i: (
+            "POST", "/products/stock", [{"id": pid, "delta": 1} for pid in batch(i, 10)])),
+        ("create_products_bulk", lambda i: (
+            "POST", "/products/bulk", [new_product() for _ in range(100)])),
+        ("update_products_bulk", lambda i: (
+            "PUT", "/products/bulk", [dict(new_product(), id=pid) for pid in batch(i)])),
+        ("delete_products", lambda i: ("DELETE", "/products/{}".format(spare_ids.pop()), None)),
+        ("delete_products_bulk", lambda i: (
+            "DELETE", "/products/bulk", [spare_ids.pop() for _ in range(10)])),
+        ("get_cache_stats", lambda i: ("GET", "/products/cache", None)),
+        ("get_pool_stats", lambda i: ("GET", "/products/pool", None)),
+        ("get_metrics", lambda i: ("GET", "/metrics", None)),
+    ]
+
+
+def seed(driver, count):
+    """ Replaces the catalog with count factory products and returns their ids """
+    driver.request("DELETE", "/products/reset")
+    ids = []
+    for start in range(0, count, 1000):
+        size = min(1000, count - start)
+        status, data = driver.request("POST", "/products/bulk", [new_product() for _ in range(size)])
+        if status != 200:
+            raise RuntimeError("Could not seed products: {}".format(status))
+        ids.extend(result["id"] for result in data["results"])
+    return ids
+
+
+def percentile(latencies, fraction):
+    """ Returns the nearest rank percentile of sorted latencies in ms """
+    index = min(len(latencies) - 1, int(round(fraction * (len(latencies) - 1))))
+    return latencies[index] * 1000
+
+
+def run_scenario(driver, make_request, iterations, concurrency):
+    """ Sends the requests of one scenario and returns its statistics """
+    # build the requests up front so making bodies is not timed
+    requests = [make_request(i) for i in range(iterations)]
+    start = time.perf_counter()
+    if driver.concurrent and concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            latencies = list(pool.map(lambda request: send(driver, request), requests))
+    else:
+        latencies = [send(driver, request) for request in requests]
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": iterations,
+        "throughput": iterations / wall,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def send(driver, request):
+    """ Sends one (method, path, body) request and returns its latency """
+    method, path, body = request
+    start = time.perf_counter()
+    status, _ = driver.request(method, path, body)
+    elapsed = time.perf_counter() - start
+    if status >= 500:
+        raise RuntimeError("{} {} failed with {}".format(method, path, status))
+    return elapsed
+
+
+def compare(results, baseline, tolerance):
+    """ Returns a message for every route whose p95 regressed past the tolerance """
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        allowed = baseline[name]["p95_ms"] * (1 + tolerance)
+        if stats["p95_ms"] > allowed:
+            regressions.append("{}: p95 {:.2f} ms > {:.2f} ms allowed (baseline {:.2f} ms)".format(
+                name, stats["p95_ms"], allowed, baseline[name]["p95_ms"]))
+    return regressions
+
+
+def benchmark(driver, args):
+    """ Seeds the catalog and runs every scenario """
+    spare = args.requests * 11  # delete_products and delete_products_bulk
+    ids = seed(driver, args.products + spare)
+    ids, spare_ids = ids[:args.products], ids[args.products:]
+    results = {}
+    for name, make_request in scenarios(ids, spare_ids):
+        if args.routes and name not in args.routes:
+            continue
+        results[name] = run_scenario(driver, make_request, args.requests, args.concurrency)
+        # keep the catalog size steady for the following scenarios
+        driver.request("DELETE", "/products/bulk", ids_created_after(ids, spare_ids, driver))
+    return results
+
+
+def ids_created_after(ids, spare_ids, driver):
+    """ Returns the ids of the products the write scenarios added """
+    known = set(ids) | set(spare_ids)
+    added, first = [], 0
+    # GET /products returns a page, so walk the catalog a page at a time
+    while True:
+        status, data = driver.request(
+            "GET", "/products?fields=id&limit=1000&id_min={}".format(first)
+        )
+        if status != 200 or not data:
+            return added
+        added.extend(item["id"] for item in data if item["id"] not in known)
+        first = data[-1]["id"] + 1
+
+
+def main():
+    """ Runs the benchmark and compares it with a baseline """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--target", choices=["client", "gunicorn"], default="client")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=100, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="gunicorn only")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn only")
+    parser.add_argument("--routes", nargs="*", help="only run these scenarios")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="fail on regressions against this results file")
+    parser.add_argument("--save-baseline", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed p95 slowdown, 0.5 means 50%% slower")
+    args = parser.parse_args()
+
+    server, path = None, None
+    if args.target == "gunicorn":
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        database_uri = os.environ["DATABASE_URI"]
+        if database_uri.startswith("sqlite"):
+            database_uri = "sqlite:///" + path  # the workers must share one database
+        port = free_port()
+        server = start_server(args.workers, port, database_uri)
+        driver = HttpDriver("http://127.0.0.1:{}".format(port))
+    else:
+        driver = ClientDriver()
+    try:
+        results = benchmark(driver, args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+            os.remove(path)
+
+    print("{:<24} {:>10} {:>10} {:>10} {:>10}".format("route", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for name, stats in results.items():
+        print("{:<24} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            name, stats["throughput"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+    for filename in filter(None, [args.output, args.save_baseline]):
+        with open(filename, "w") as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as handle:
+            regressions = compare(results, json.load(handle), args.tolerance)
+        for message in regressions:
+            print("REGRESSION " + message)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
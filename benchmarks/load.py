@@ -0,0 +1,141 @@
+"""
+Load Test for the Products Service
+
+Starts the service under gunicorn with 1, 4 and 16 workers in turn, seeds
+it with products and reports the throughput and latency of a mix of reads
+and stock writes at each size. Run it from the repository root:
+
+    python -m benchmarks.load --workers 1,4,16 --worker-class gthread
+
+Without --database-uri each run uses a fresh SQLite file, which serializes
+writers; point it at Postgres to measure a production-like setup.
+"""
+import os
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def free_port():
+    """ Returns a TCP port nobody is listening on """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def call(base_url, method, path, body=None):
+    """ Sends one request and returns its latency in seconds """
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method)
+    req.add_header("Content-Type", "application/json")
+    start = time.perf_counter()
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        resp.read()
+    return time.perf_counter() - start
+
+
+def start_server(workers, port, database_uri, worker_class="gthread", threads=4):
+    """ Starts gunicorn and waits until it answers """
+    env = dict(
+        os.environ,
+        DATABASE_URI=database_uri,
+        PORT=str(port),
+        WEB_CONCURRENCY=str(workers),
+        GUNICORN_WORKER_CLASS=worker_class,
+        GUNICORN_THREADS=str(threads),
+    )
+    server = subprocess.Popen(
+        ["gunicorn", "--config=gunicorn.conf.py",
+         "--log-level=warning", "service:app"],
+        env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            call("http://127.0.0.1:{}".format(port), "GET", "/products?limit=1")
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start")
+
+
+def seed(base_url, count):
+    """ Creates count products through the bulk endpoint """
+    products = [
+        {
+            "name": "product-{}".format(n),
+            "sku": "{:08d}".format(n),
+            "available": True,
+            "price": round(random.uniform(1, 100), 2),
+            "stock": 1000000,
+            "size": random.choice(["S", "M", "L"]),
+            "color": random.choice(["blue", "red", "yellow"]),
+            "category": random.choice(["paper", "electronics", "food"]),
+            "description": "load test product",
+        }
+        for n in range(count)
+    ]
+    call(base_url, "POST", "/products/bulk", products)
+
+
+def run_load(base_url, args):
+    """ Drives the request mix and returns the latencies and wall time """
+    def one_request(_):
+        roll = random.random()
+        product_id = random.randint(1, args.products)
+        if roll < 0.6:
+            return call(base_url, "GET", "/products/{}".format(product_id))
+        if roll < 0.9:
+            return call(base_url, "GET", "/products?category=food&limit=20")
+        return call(base_url, "POST", "/products/{}/stock".format(product_id), {"delta": -1})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = sorted(pool.map(one_request, range(args.requests)))
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    """ Runs the load test at every worker count """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", default="1,4,16")
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--database-uri")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>10} {:>10} {:>10}".format(
+        "workers", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for workers in [int(n) for n in args.workers.split(",")]:
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        database_uri = args.database_uri or "sqlite:///" + path
+        port = free_port()
+        server = start_server(workers, port, database_uri, args.worker_class, args.threads)
+        try:
+            base_url = "http://127.0.0.1:{}".format(port)
+            call(base_url, "DELETE", "/products/reset")
+            seed(base_url, args.products)
+            latencies, elapsed = run_load(base_url, args)
+        finally:
+            server.terminate()
+            server.wait()
+            os.remove(path)
+        def pct(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            workers, len(latencies) / elapsed, pct(0.50), pct(0.95), pct(0.99)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Serialization Benchmark for GET /products
+
+Compares the ORM path (hydrate Product objects, call serialize() and
+jsonify) with the Core row path list_products uses (select the columns,
+zip the row tuples into dicts and encode them with orjson or json) at
+several catalog sizes. Run it from the repository root:
+
+    python -m benchmarks.serialization --sizes 1000,10000,100000
+
+It uses an in-memory SQLite database unless DATABASE_URI is set.
+"""
+import os
+import time
+import random
+import argparse
+from unittest.mock import patch
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+from flask import jsonify  # noqa: E402
+from service import app, encoding  # noqa: E402
+from service.models import Product, db  # noqa: E402
+
+
+def seed(count):
+    """ Replaces the catalog with count products """
+    Product.query.delete()
+    rows = [
+        {
+            "name": "product-{}".format(n),
+            "sku": "{:08d}".format(n),
+            "available": n % 2 == 0,
+            "price": round(random.uniform(1, 100), 2),
+            "stock": random.randint(0, 100),
+            "size": random.choice(["S", "M", "L"]),
+            "color": random.choice(["blue", "red", "yellow"]),
+            "category": random.choice(["paper", "electronics", "food"]),
+            "description": "benchmark product",
+        }
+        for n in range(count)
+    ]
+    db.session.execute(Product.__table__.insert(), rows)
+    db.session.commit()
+
+
+def orm_path():
+    """ The original list_products: ORM objects, serialize() and jsonify """
+    products = Product.query.order_by(Product.id).all()
+    return jsonify([product.serialize() for product in products]).get_data()
+
+
+def core_path():
+    """ The row path: Core SELECT, tuples zipped into dicts, fast encoder """
+    stmt = Product.select_rows()
+    rows = Product.fetch_rows(stmt)
+    return encoding.dumps(encoding.rows_to_dicts(stmt.c.keys(), rows))
+
+
+def core_stdlib_path():
+    """ The row path with the json module instead of orjson """
+    with patch.object(encoding, "orjson", None):
+        return core_path()
+
+
+def best_of(func, repeat):
+    """ Returns the fastest of repeat runs in milliseconds """
+    timings = []
+    for _ in range(repeat):
+        db.session.expunge_all()  # no warm identity map between runs
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def main():
+    """ Runs every path at every catalog size """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    app.logger.setLevel("WARNING")
+    Product.create_schema()  # no request runs, so the lazy schema is never made
+
+    paths = [("orm", orm_path), ("core+json", core_stdlib_path)]
+    if encoding.orjson is not None:
+        paths.append(("core+orjson", core_path))
+    print("{:>8}".format("rows") + "".join("{:>16}".format(name + " ms") for name, _ in paths))
+    with app.test_request_context():
+        for size in [int(n) for n in args.sizes.split(",")]:
+            seed(size)
+            timings = [best_of(func, args.repeat) for _, func in paths]
+            print("{:>8}".format(size) + "".join("{:>16.1f}".format(ms) for ms in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Startup Benchmark for the Products Service
+
+Measures what a cold gunicorn worker pays before it can answer: importing
+the service package, creating the app and answering the first request,
+for every DB_SCHEMA mode. Each sample runs in a fresh interpreter so the
+imports are really cold. Run it from the repository root:
+
+    python -m benchmarks.startup --runs 10
+
+It uses a fresh SQLite file unless --database-uri is given; point it at
+Postgres to include the network round trips of the schema inspection.
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+# Runs in the child interpreter and prints its timings as JSON
+PROBE = """
+import json, time
+start = time.perf_counter()
+import service
+imported = time.perf_counter()
+app = service.create_app()
+created = time.perf_counter()
+app.test_client().get("/products?limit=1")
+answered = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_request_ms": (answered - created) * 1000,
+    "total_ms": (answered - start) * 1000,
+}))
+"""
+
+COLUMNS = ("import_ms", "create_app_ms", "first_request_ms", "total_ms")
+
+
+def sample(database_uri, schema):
+    """ Starts one interpreter and returns its timings """
+    env = dict(os.environ, DATABASE_URI=database_uri, DB_SCHEMA=schema)
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], env=env, check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    ).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    """ Samples every DB_SCHEMA mode and prints the median timings """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--database-uri")
+    parser.add_argument("--modes", default="eager,lazy,skip")
+    args = parser.parse_args()
+
+    handle, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    database_uri = args.database_uri or "sqlite:///" + path
+    try:
+        # the tables exist, as they do for every worker after the first deploy
+        sample(database_uri, "eager")
+        print("{:<8}".format("mode") + "".join("{:>18}".format(name) for name in COLUMNS))
+        for schema in args.modes.split(","):
+            runs = [sample(database_uri, schema) for _ in range(args.runs)]
+            medians = [statistics.median(run[name] for run in runs) for name in COLUMNS]
+            print("{:<8}".format(schema) + "".join("{:>18.1f}".format(ms) for ms in medians))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,5 +12,69 @@ if 'VCAP_SERVICES' in os.environ:
 # Configure SQLAlchemy
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# When to create the tables: eager (at startup), lazy (before the first
+# request, so a worker boots without touching the database) or skip
+DB_SCHEMA = os.getenv("DB_SCHEMA", "lazy")
+# Connection pool of each worker (see service/pool.py). By default it fits the
+# gunicorn threads (see gunicorn.conf.py); gevent workers share a smaller pool
+# and queue for a connection instead. DB_PGBOUNCER turns the pool off.
+WORKER_CLASS = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+WORKER_CONCURRENCY = 10 if WORKER_CLASS == "gevent" else int(os.getenv("GUNICORN_THREADS", "4"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(max(WORKER_CONCURRENCY, 5))))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "false").lower() in ("1", "true", "yes")
+# Comma separated read replicas of DATABASE_URI. GET requests read from them
+# in turn, skipping any that failed a health check in the last
+# REPLICA_CHECK_SECONDS; clients that just wrote read from the primary for
+# REPLICA_STICKY_SECONDS so they see their own writes (see service/replicas.py)
+DATABASE_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+REPLICA_CHECK_SECONDS = float(os.getenv("REPLICA_CHECK_SECONDS", "5"))
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
 # Secret for session management
-SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
\ No newline at end of file
+SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+# Page size of GET /products without limit, and the largest page a client
+# may request with it; ?stream=1 exports the whole catalog
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "100"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "1000"))
+# Rows fetched per round trip when streaming GET /products?stream=1
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+# Products written per transaction by the /products/bulk endpoints
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+# Read cache backend (memory, file or redis), the number of serialized products
+# it keeps (0 disables it) and their lifetime in seconds
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_PATH = os.getenv("CACHE_PATH", "/tmp/products-cache.sqlite")
+CACHE_REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+# Opt-in request profiling (see service/profiling.py)
+SQL_PROFILING = os.getenv("SQL_PROFILING", "false").lower() in ("1", "true", "yes")
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.5"))
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+# gzip or brotli compression of JSON, NDJSON and MessagePack responses larger
+# than COMPRESS_MIN_SIZE bytes (see service/compression.py)
+COMPRESS_RESPONSES = os.getenv("COMPRESS_RESPONSES", "true").lower() in ("1", "true", "yes")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "4"))
+# Changes per response of GET /products/changes
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "500"))
+# GET /products/events sends a comment every EVENTS_HEARTBEAT_SECONDS while
+# nothing changes and ends streams after EVENTS_STREAM_SECONDS for clients
+# to reconnect; a client more than EVENTS_QUEUE_SIZE commits behind is cut
+# off. GET /products/changes?wait= waits at most LONG_POLL_MAX_SECONDS
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+EVENTS_STREAM_SECONDS = float(os.getenv("EVENTS_STREAM_SECONDS", "300"))
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "1000"))
+LONG_POLL_MAX_SECONDS = float(os.getenv("LONG_POLL_MAX_SECONDS", "30"))
+# Most ids or SKUs one GET /products?ids= or POST /products/lookup may ask
+# for, and the most put in one SELECT ... IN
+LOOKUP_MAX_ITEMS = int(os.getenv("LOOKUP_MAX_ITEMS", "1000"))
+LOOKUP_BATCH_SIZE = int(os.getenv("LOOKUP_BATCH_SIZE", "500"))
+# Default width of the price buckets of GET /products/facets
+FACET_PRICE_BUCKET = int(os.getenv("FACET_PRICE_BUCKET", "10"))
+# Results per page of GET /products/search
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))
@@ -0,0 +1,50 @@
+"""
+Gunicorn Configuration for the Products Service
+
+Every knob can be set from the environment:
+
+WEB_CONCURRENCY - the number of worker processes (default 1)
+GUNICORN_WORKER_CLASS - sync, gthread (default) or gevent
+GUNICORN_THREADS - the threads per gthread worker (default 4)
+GUNICORN_WORKER_CONNECTIONS - the greenlets per gevent worker (default 100)
+GUNICORN_TIMEOUT - the seconds before a silent worker is restarted (default 30)
+GUNICORN_PRELOAD_APP - create the app once in the master and fork the
+    workers from it, so they boot faster and share its memory (default false)
+prometheus_multiproc_dir - a directory shared by the workers for their metrics
+
+With gthread or gevent one slow database query only blocks its own
+thread or greenlet. config.py sizes each worker's SQLAlchemy pool from
+the same variables so every thread can hold a connection.
+"""
+import os
+
+bind = "0.0.0.0:{}".format(os.getenv("PORT", "5000"))
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+preload_app = os.getenv("GUNICORN_PRELOAD_APP", "false").lower() in ("1", "true", "yes")
+errorlog = "-"
+
+
+def post_fork(server, worker):
+    """ Makes psycopg2 cooperative when running on gevent """
+    if worker_class == "gevent":
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        server.log.info("Patched psycopg2 for gevent in worker %s", worker.pid)
+    if preload_app:
+        # a worker must not share the database sockets the master opened
+        from service.models import db
+        app = server.app.wsgi()  # the app the master preloaded
+        with app.app_context():
+            for bind in [None] + list(app.config.get("SQLALCHEMY_BINDS") or {}):
+                db.get_engine(app, bind=bind).dispose()
+
+
+def child_exit(server, worker):
+    """ Drops the live gauges of a worker that exited from the shared metrics """
+    if "prometheus_multiproc_dir" in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
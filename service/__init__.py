@@ -1,23 +1,32 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+create_app() creates and configures a Flask app and sets up the logging
+and SQL database. The default app, service.app, is only created the first
+time it is used, so importing the package costs no database round trip:
+
+    gunicorn "service:create_app()"    # one app per worker, or per master with preload
+    gunicorn service:app               # the default app
 """
-import os
 import sys
 import logging
 from flask import Flask
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object('config')
-
-# Import the rutes After the Flask app is created
+# Import the routes and models, they are added to each app by create_app()
 from service import service, models
 
-# Set up logging for production
-if __name__ != '__main__':
+
+def create_app(config=None):
+    """ Creates and configures a Flask app for the service
+
+    Args:
+        config (dict): settings that override the ones in config.py
+    """
+    app = Flask(__name__)
+    app.config.from_object('config')
+    app.config.update(config or {})
+
+    # Set up logging for production
     gunicorn_logger = logging.getLogger('gunicorn.error')
     app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
@@ -28,15 +37,27 @@ if __name__ != '__main__':
         handler.setFormatter(formatter)
     app.logger.info('Logging handler established')
 
-app.logger.info(70 * "*")
-app.logger.info("  P R O D U C T S   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
+    app.logger.info(70 * "*")
+    app.logger.info("  P R O D U C T S   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    app.logger.info(70 * "*")
+
+    try:
+        service.init_app(app)  # make our sqlalchemy tables
+    except Exception as error:
+        app.logger.critical("%s: Cannot continue", error)
+        # gunicorn requires exit code 4 to stop spawning workers when they die
+        sys.exit(4)
+
+    app.logger.info("Service inititalized!")
+    return app
 
-try:
-    service.init_db()  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
 
-app.logger.info("Service inititalized!")
+def __getattr__(name):
+    """ Creates the default app the first time service.app is used """
+    if name != "app":
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    global app
+    app = create_app()
+    # scripts and tests use the models outside of any request
+    app.app_context().push()
+    return app
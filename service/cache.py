@@ -0,0 +1,354 @@
+"""
+Caches for Products
+
+The service keeps serialized products in a cache in front of the database
+so repeated reads of the same product do not need a query. The backend is
+chosen with CACHE_BACKEND:
+
+memory - a bounded LRU cache private to each worker process
+file - a SQLite file shared by every worker on the same host
+redis - a Redis server shared by every worker and replica
+
+Writes invalidate the shared backends for all workers at once, while the
+memory backend relies on CACHE_TTL to expire what other workers changed.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # only needed for CACHE_BACKEND=redis
+    redis = None
+
+
+class Cache:
+    """
+    Interface of the product cache backends
+
+    Values must be JSON serializable so every backend can store them.
+    """
+
+    backend = None
+
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the value cached for a key or None """
+        raise NotImplementedError
+
+    def set(self, key, value):
+        """ Caches a value for a key """
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """ Returns the values cached for the keys that have one, by key """
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set_many(self, values):
+        """ Caches the values of a dict by their keys """
+        for key, value in values.items():
+            self.set(key, value)
+
+    def delete(self, *keys):
+        """ Removes the given keys from the cache """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        raise NotImplementedError
+
+    def count(self):
+        """ Returns the number of entries in the cache """
+        raise NotImplementedError
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counters of the cache """
+        return {
+            "backend": self.backend,
+            "size": self.count(),
+            "max_size": self.size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class LRUCache(Cache):
+    """
+    A bounded in-process cache with least recently used eviction
+
+    Entries also expire ttl seconds after they were set. A size of 0
+    disables the cache so every lookup is a miss.
+    """
+
+    backend = "memory"
+
+    def __init__(self, size=10000, ttl=60):
+        super().__init__(size, ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value cached for a key or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """ Caches a value for a key, evicting the least recently used """
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        """ Removes the given keys from the cache """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        with self._lock:
+            self._entries.clear()
+
+    def count(self):
+        """ Returns the number of entries in the cache """
+        with self._lock:
+            return len(self._entries)
+
+
+class FileCache(Cache):
+    """
+    A cache kept in a SQLite file that every worker on the host shares
+
+    Once the file holds more than size entries the ones set longest ago
+    are evicted. Each process opens its own connection, so the cache can
+    be created before gunicorn forks its workers.
+    """
+
+    backend = "file"
+    PRUNE_EVERY = 100  # sets between two evictions of old entries
+    BATCH_SIZE = 500  # keys read per SELECT by get_many
+
+    def __init__(self, path, size=10000, ttl=60):
+        super().__init__(size, ttl)
+        self.path = path
+        self._sets = 0
+        self._pid = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        """ Returns the connection of this process, opening it if needed """
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        """ Returns the value cached for a key or None """
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM cache WHERE key = ? AND expires >= ?",
+                (str(key), time.time()),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key, value):
+        """ Caches a value for a key """
+        self.set_many({key: value})
+
+    def get_many(self, keys):
+        """ Returns the values cached for the keys that have one, by key """
+        keys = {str(key): key for key in keys}
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            names = list(keys)
+            # SQLite allows 999 parameters per statement
+            for start in range(0, len(names), self.BATCH_SIZE):
+                batch = names[start:start + self.BATCH_SIZE]
+                rows = conn.execute(
+                    "SELECT key, value FROM cache WHERE key IN ({}) AND expires >= ?".format(
+                        ",".join("?" * len(batch))
+                    ),
+                    batch + [time.time()],
+                ).fetchall()
+                for name, value in rows:
+                    found[keys[name]] = json.loads(value)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, values):
+        """ Caches the values of a dict by their keys in one transaction """
+        if self.size <= 0 or not values:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                [(str(key), json.dumps(value), expires) for key, value in values.items()],
+            )
+            pruned = self._sets // self.PRUNE_EVERY
+            self._sets += len(values)
+            if self._sets // self.PRUNE_EVERY > pruned:
+                self._prune(conn)
+            conn.commit()
+
+    def _prune(self, conn):
+        """ Drops expired entries and the oldest ones beyond the size limit """
+        conn.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+        excess = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.size
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY expires LIMIT ?)",
+                (excess,),
+            )
+            self.evictions += excess
+
+    def delete(self, *keys):
+        """ Removes the given keys from the cache """
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("DELETE FROM cache WHERE key = ?", [(str(key),) for key in keys])
+            conn.commit()
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM cache")
+            conn.commit()
+
+    def count(self):
+        """ Returns the number of entries in the cache """
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class RedisCache(Cache):
+    """
+    A cache kept in a Redis server that every worker and replica shares
+
+    Redis expires the entries itself and evicts under its own maxmemory
+    policy, so size is only reported. Any client with the redis-py
+    get/set/delete/scan_iter methods can be passed in instead of a URL.
+    """
+
+    backend = "redis"
+
+    def __init__(self, url=None, size=10000, ttl=60, client=None, prefix="product:"):
+        super().__init__(size, ttl)
+        if client is None:
+            if redis is None:
+                raise RuntimeError("CACHE_BACKEND=redis requires the redis package")
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, key):
+        return "{}{}".format(self.prefix, key)
+
+    def get(self, key):
+        """ Returns the value cached for a key or None """
+        value = self.client.get(self._key(key))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        """ Caches a value for a key """
+        if self.size <= 0:
+            return
+        self.client.set(self._key(key), json.dumps(value), px=int(self.ttl * 1000))
+
+    def get_many(self, keys):
+        """ Returns the values cached for the keys that have one, with one MGET """
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self._key(key) for key in keys])
+        found = {key: json.loads(value) for key, value in zip(keys, values) if value is not None}
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, values):
+        """ Caches the values of a dict by their keys in one round trip """
+        if self.size <= 0 or not values:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(self._key(key), json.dumps(value), px=int(self.ttl * 1000))
+        pipeline.execute()
+
+    def delete(self, *keys):
+        """ Removes the given keys from the cache """
+        if keys:
+            self.client.delete(*[self._key(key) for key in keys])
+
+    def clear(self):
+        """ Removes every product entry from the cache """
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def count(self):
+        """ Returns the number of product entries in the cache """
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + "*"))
+
+
+def make_cache(config):
+    """ Creates the cache backend selected by the application config """
+    backend = config["CACHE_BACKEND"]
+    size, ttl = config["CACHE_SIZE"], config["CACHE_TTL"]
+    if backend == "memory":
+        return LRUCache(size, ttl)
+    if backend == "file":
+        return FileCache(config["CACHE_PATH"], size, ttl)
+    if backend == "redis":
+        return RedisCache(config["CACHE_REDIS_URL"], size, ttl)
+    raise ValueError("Unknown CACHE_BACKEND: {}".format(backend))
@@ -0,0 +1,135 @@
+"""
+Response Compression
+
+Compresses the JSON, NDJSON and MessagePack responses of the service for
+clients that send Accept-Encoding. It is controlled by settings in
+config.py:
+
+COMPRESS_RESPONSES - turn compression on or off
+COMPRESS_MIN_SIZE - bodies smaller than this many bytes are sent as they
+    are, compressing them costs more than it saves
+COMPRESS_LEVEL - the gzip level, 1 (fastest) to 9 (smallest)
+COMPRESS_BROTLI_QUALITY - the brotli quality, 0 (fastest) to 11 (smallest)
+
+Brotli is preferred when the client accepts it and the brotli package is
+installed, gzip is used otherwise. Streamed responses are compressed as
+their chunks are generated, so a large list never sits in memory.
+
+A compressed body is a different representation from the plain one, so its
+strong ETag gets the coding as a suffix ("abc-gzip"). The suffix is taken
+off the If-Match and If-None-Match headers before the views compare them,
+so a client may send back whichever ETag it was given.
+"""
+
+import re
+import zlib
+from flask import g, request, current_app
+from werkzeug.http import parse_etags
+from service.metrics import timed_phase
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE = (
+    "application/json", "application/x-ndjson", "application/msgpack",
+    "text/html", "text/plain",
+)
+# statuses whose body is empty or must be sent byte for byte
+UNCOMPRESSED_STATUSES = (204, 206, 304)
+CODINGS = ("br", "gzip")
+# the coding suffix of a quoted ETag
+ETAG_CODING = re.compile(r'-(?:{})"'.format("|".join(CODINGS)))
+
+
+def init_compression(app):
+    """ Compresses the responses of the app """
+    app.before_request(strip_etag_codings)
+    app.after_request(compress_response)
+
+
+def strip_etag_codings():
+    """ Lets the views compare validators sent back with a coding suffix """
+    g.if_none_match = parse_etags(request.environ.get("HTTP_IF_NONE_MATCH"))
+    for header in ("HTTP_IF_MATCH", "HTTP_IF_NONE_MATCH"):
+        value = request.environ.get(header)
+        if value:
+            request.environ[header] = ETAG_CODING.sub('"', value)
+
+
+def coding_etag(response, coding):
+    """ Marks the strong ETag of a response with the coding of its body """
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag("{}-{}".format(etag, coding))
+
+
+def choose_encoding():
+    """ Returns the best content coding the client accepts, or None """
+    codings = ["br", "gzip"] if brotli is not None else ["gzip"]
+    return request.accept_encodings.best_match(codings)
+
+
+def compressor(coding):
+    """ Returns the compress and flush functions of a new compressor """
+    config = current_app.config
+    if coding == "br":
+        engine = brotli.Compressor(quality=config["COMPRESS_BROTLI_QUALITY"])
+        return engine.process, engine.finish
+    # wbits 31 writes the gzip header and trailer
+    engine = zlib.compressobj(config["COMPRESS_LEVEL"], zlib.DEFLATED, 31)
+    return engine.compress, engine.flush
+
+
+def compress_response(response):
+    """ Compresses the body of a response if the client accepts it """
+    config = current_app.config
+    if response.status_code == 304:
+        # echo the coded ETag the client validated with
+        etag, weak = response.get_etag()
+        sent = g.get("if_none_match")
+        for coding in CODINGS:
+            if etag and not weak and sent and sent.contains("{}-{}".format(etag, coding)):
+                coding_etag(response, coding)
+        return response
+    if (
+        not config.get("COMPRESS_RESPONSES")
+        or response.mimetype not in COMPRESSIBLE
+        or response.status_code < 200
+        or response.status_code in UNCOMPRESSED_STATUSES
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    coding = choose_encoding()
+    if coding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_chunks(response.response, *compressor(coding))
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+    else:
+        if response.content_length is None or response.content_length < config["COMPRESS_MIN_SIZE"]:
+            return response
+        with timed_phase("compress"):
+            compress, flush = compressor(coding)
+            response.set_data(compress(response.get_data()) + flush())
+    response.headers["Content-Encoding"] = coding
+    coding_etag(response, coding)
+    return response
+
+
+def _compress_chunks(chunks, compress, flush):
+    """ Compresses the chunks of a streamed body as they are generated """
+    try:
+        for chunk in chunks:
+            data = compress(chunk)
+            if data:  # the compressor holds small chunks back until it has a block
+                yield data
+        yield flush()
+    finally:
+        # lets stream_with_context release the request of the original stream
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
@@ -0,0 +1,51 @@
+"""
+JSON Encoding for the Products Service
+
+Encodes response bodies with orjson when it is installed, which is several
+times faster than the standard library on large product lists, and falls
+back to the json module otherwise. With the msgpack package installed,
+clients may ask for MessagePack instead, which is smaller and faster to
+parse than JSON.
+"""
+
+import json
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # optional binary format
+    msgpack = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+
+
+def mimetypes():
+    """ Returns the body formats that can be served, JSON first """
+    return [JSON, MSGPACK] if msgpack is not None else [JSON]
+
+
+def dumps(data, mimetype=JSON):
+    """ Encodes data as compact JSON bytes, or as MessagePack if asked to """
+    if mimetype == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True, default=_default)
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":"), default=_default).encode()
+
+
+def _default(value):
+    """ Encodes the datetimes of Core rows like orjson and serialize() do """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("{!r} cannot be encoded".format(value))
+
+
+def rows_to_dicts(names, rows):
+    """ Turns row tuples into dictionaries keyed by their column names """
+    return [dict(zip(names, row)) for row in rows]
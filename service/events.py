@@ -0,0 +1,212 @@
+"""
+Product Events
+
+Every commit that creates, updates, deletes or restocks products through
+the Product methods publishes one event per product:
+
+    {"op": "restock", "id": 42, "version": 1234}
+
+where version is the catalog version of the change feed. GET
+/products/events and GET /products/changes?wait= use them to read the
+change feed as soon as something changes; the events the clients get are
+read from the feed, which on PostgreSQL holds back versions that may still
+be followed by lower ones.
+
+On PostgreSQL the events are sent with NOTIFY inside the transaction that
+wrote them, so they are delivered when, and only if, it commits, and every
+gunicorn worker receives them on a LISTEN connection of its own. Other
+databases have no such channel, so the events only reach the subscribers
+of the process that committed them.
+"""
+
+import json
+import time
+import queue
+import select
+import logging
+import threading
+from sqlalchemy import text
+from sqlalchemy.orm import scoped_session
+
+logger = logging.getLogger("flask.app")
+
+CHANNEL = "product_events"
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7000
+# the events of a transaction waiting for its commit
+PENDING_EVENTS = "product_events"
+
+
+class Subscription:
+    """ The queue of event batches of one streaming or polling client """
+
+    def __init__(self, size):
+        self._queue = queue.Queue(size)
+        self.overflowed = False
+
+    def put(self, events):
+        """ Queues a batch, or marks the subscription overflowed when it is full """
+        try:
+            self._queue.put_nowait(events)
+        except queue.Full:
+            # a client this far behind has to catch up from the change feed
+            self.overflowed = True
+
+    def get(self, timeout):
+        """ Returns the next batch of events, or None after timeout seconds """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    """ Publishes the committed product events to the subscribers of this process """
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """ Returns a new Subscription to the events """
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Stops delivering events to a Subscription """
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, events):
+        """ Delivers a batch of events to every subscription """
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.put(events)
+
+    def send(self, session, events):
+        """ Sends the events of a write when its transaction commits """
+        session.info.setdefault(PENDING_EVENTS, []).extend(events)
+
+    def committed(self, session):
+        """ Publishes the events of a transaction that just committed """
+        events = session.info.pop(PENDING_EVENTS, None)
+        if events:
+            self.publish(events)
+
+
+class PostgresEventBus(EventBus):
+    """ Sends the events with NOTIFY and receives them with LISTEN """
+
+    poll_seconds = 5
+    retry_seconds = 1
+
+    def __init__(self, engine, queue_size=1000):
+        super().__init__(queue_size)
+        self.engine = engine
+        self._listener = None
+
+    def subscribe(self):
+        # the worker starts listening with its first subscriber, after the fork
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(
+                    target=self._listen, name="product-events", daemon=True
+                )
+                self._listener.start()
+        return super().subscribe()
+
+    def send(self, session, events):
+        for payload in _payloads(events):
+            session.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": CHANNEL, "payload": payload},
+            )
+
+    def committed(self, session):
+        pass  # the listener delivers them, in this worker like in all others
+
+    def _listen(self):
+        while True:
+            try:
+                self._receive()
+            except Exception as error:  # pylint: disable=broad-except
+                logger.warning("Lost the product event listener: %s", error)
+            # events sent while not listening are lost, so the subscribers
+            # are cut off to catch up from the change feed
+            with self._lock:
+                for subscription in self._subscriptions:
+                    subscription.overflowed = True
+            time.sleep(self.retry_seconds)
+
+    def _receive(self):
+        connection = self.engine.raw_connection()
+        connection.detach()  # a connection of its own that never goes back to the pool
+        try:
+            dbapi = connection.connection
+            dbapi.autocommit = True
+            dbapi.cursor().execute("LISTEN " + CHANNEL)
+            while True:
+                if select.select([dbapi], [], [], self.poll_seconds) == ([], [], []):
+                    continue
+                dbapi.poll()
+                while dbapi.notifies:
+                    self.publish(json.loads(dbapi.notifies.pop(0).payload))
+        finally:
+            connection.close()
+
+
+def _payloads(events):
+    """ Encodes events as JSON arrays that fit in a NOTIFY payload """
+    batch, size = [], 2
+    for event in events:
+        encoded = json.dumps(event, separators=(",", ":"))
+        if batch and size + len(encoded) + 1 > MAX_PAYLOAD:
+            yield "[" + ",".join(batch) + "]"
+            batch, size = [], 2
+        batch.append(encoded)
+        size += len(encoded) + 1
+    if batch:
+        yield "[" + ",".join(batch) + "]"
+
+
+def init_events(app, engine):
+    """ Creates the event bus of the app for its database """
+    queue_size = app.config.get("EVENTS_QUEUE_SIZE", 1000)
+    if engine.dialect.name == "postgresql":
+        bus = PostgresEventBus(engine, queue_size)
+    else:
+        bus = EventBus(queue_size)
+    app.extensions["events"] = bus
+    return bus
+
+
+def record(session, op, ids, version):
+    """ Records the events of a write in the transaction of a session
+
+    Args:
+        op (str): create, update, delete or restock
+        ids (iterable): the ids of the products written
+        version (int): the catalog version of the transaction
+    """
+    if isinstance(session, scoped_session):
+        session = session()
+    bus = session.app.extensions.get("events")
+    if bus is not None and ids:
+        bus.send(session, [{"op": op, "id": by_id, "version": version} for by_id in sorted(ids)])
+
+
+def committed(session):
+    """ Publishes the events of a session's transaction after its commit """
+    bus = session.app.extensions.get("events")
+    if bus is not None:
+        bus.committed(session)
+    session.info.pop(PENDING_EVENTS, None)
+
+
+def discard(session):
+    """ Drops the events of a session's transaction after its rollback """
+    session.info.pop(PENDING_EVENTS, None)
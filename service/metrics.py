@@ -0,0 +1,120 @@
+"""
+Prometheus Metrics for the Products Service
+
+Times every request per route together with the database queries it ran,
+the time it spent serializing products and the size of its response.
+
+Under gunicorn set prometheus_multiproc_dir to an empty directory that all
+workers share; every worker then writes its samples there and GET /metrics
+adds them up, no matter which worker answers the scrape.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+)
+from prometheus_client import multiprocess
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SERIALIZE_PHASES = ("serialize", "jsonify")
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+REQUESTS = Counter(
+    "products_http_requests_total", "HTTP requests served",
+    ["route", "method", "status"],
+)
+LATENCY = Histogram(
+    "products_http_request_duration_seconds", "Time spent answering a request",
+    ["route", "method"], buckets=LATENCY_BUCKETS,
+)
+DB_QUERIES = Histogram(
+    "products_db_queries_per_request", "SQL statements run by a request",
+    ["route"], buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100),
+)
+DB_TIME = Histogram(
+    "products_db_duration_seconds", "Time a request spent running SQL",
+    ["route"], buckets=LATENCY_BUCKETS,
+)
+SERIALIZE_TIME = Histogram(
+    "products_serialization_duration_seconds", "Time a request spent serializing products",
+    ["route"], buckets=LATENCY_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    "products_http_response_size_bytes", "Size of the response body",
+    ["route"], buckets=SIZE_BUCKETS,
+)
+
+
+def init_metrics(app):
+    """ Starts timing the requests of the app and the SQL they run """
+    app.before_request(_start_request)
+    app.after_request(_record_request)
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.db_queries = 0
+    g.db_seconds = 0.0
+    g.phase_seconds = {}
+
+
+def _record_request(response):
+    if "metrics_start" not in g:
+        return response
+    # label with the view name, without the blueprint prefix
+    route = (request.endpoint or "unknown").rpartition(".")[2]
+    REQUESTS.labels(route, request.method, response.status_code).inc()
+    LATENCY.labels(route, request.method).observe(time.perf_counter() - g.metrics_start)
+    DB_QUERIES.labels(route).observe(g.db_queries)
+    DB_TIME.labels(route).observe(g.db_seconds)
+    serialize_seconds = sum(g.phase_seconds.get(phase, 0.0) for phase in SERIALIZE_PHASES)
+    if serialize_seconds:
+        SERIALIZE_TIME.labels(route).observe(serialize_seconds)
+    if response.content_length is not None:
+        RESPONSE_SIZE.labels(route).observe(response.content_length)
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    if has_app_context() and "metrics_start" in g:
+        g.db_queries += 1
+        g.db_seconds += elapsed
+
+
+@contextmanager
+def timed_phase(phase):
+    """ Adds the time spent in the block to the named phase of the request
+
+    The orm phase covers running a query and building its objects, serialize
+    turning them into dicts and jsonify encoding the response body
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_app_context() and "metrics_start" in g:
+            elapsed = time.perf_counter() - start
+            g.phase_seconds[phase] = g.phase_seconds.get(phase, 0.0) + elapsed
+
+
+def render_metrics():
+    """ Returns the metrics in the Prometheus text format and its content type """
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -5,29 +5,133 @@ All of the models are stored in this module
 """
 
 import logging
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from flask import has_app_context
+from sqlalchemy import inspect, event
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from service import events
+from service.cache import LRUCache, make_cache
+from service.pool import engine_options
+from service.replicas import ReplicaSet, RoutingSQLAlchemy, replica_binds, reading_from_replica
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
+
+# Text searched by Product.select_search on Postgres. The GIN index is built
+# on exactly this expression, so the planner can use it for the query.
+SEARCH_DOCUMENT = (
+    "to_tsvector('english', coalesce(name, '') || ' ' || "
+    "coalesce(description, '') || ' ' || coalesce(category, ''))"
+)
+# Postgres only indexes that create_all() cannot declare portably
+POSTGRES_INDEXES = {
+    "ix_product_search": "USING gin ({})".format(SEARCH_DOCUMENT),
+    "ix_product_name_trgm": "USING gin (name gin_trgm_ops)",
+}
+
+
+# A single row counter for databases other than Postgres. Every transaction
+# that changes products takes the next value and stamps it on the rows it
+# writes; the row stays locked until the commit, so versions become visible
+# in the order they were handed out. SQLite runs one writer at a time anyway,
+# Postgres uses transaction ids instead (see Product.next_version).
+catalog_version = db.Table(
+    "catalog_version",
+    db.Column("id", db.Integer, primary_key=True),
+    db.Column("value", db.BigInteger, nullable=False),
+)
+# The deleted products, so the change feed can report deletes
+product_tombstone = db.Table(
+    "product_tombstone",
+    db.Column("id", db.Integer, primary_key=True),
+    db.Column("version", db.BigInteger, nullable=False),
+    db.Column("deleted_at", db.DateTime, nullable=False),
+    db.Index("ix_product_tombstone_version", "version", "id"),
+)
+
+# Product counts and price totals per facet value, kept up to date by the
+# triggers of _create_facet_triggers, so facets cost O(facet values) to read.
+# priced counts the products with a price, the ones price_total adds up.
+product_facet = db.Table(
+    "product_facet",
+    db.Column("facet", db.String(16), primary_key=True),
+    db.Column("value", db.String(63), primary_key=True),
+    db.Column("count", db.BigInteger, nullable=False),
+    db.Column("priced", db.BigInteger, nullable=False, server_default="0"),
+    db.Column("price_total", db.Float, nullable=False),
+)
+# The value counted for each facet of a product row ({row} is its prefix, e.g.
+# NEW.). NULLs count as '', and prices in one row per whole number, which
+# GET /products/facets groups into histogram buckets of any width.
+FACETS = {
+    "all": "''",
+    "category": "coalesce({row}category, '')",
+    "color": "coalesce({row}color, '')",
+    "size": "coalesce({row}size, '')",
+    "available": "CASE WHEN {row}available IS NULL THEN '' "
+                 "WHEN {row}available THEN 'true' ELSE 'false' END",
+    "price": "coalesce(CAST({floor} AS TEXT), '')",
+}
+PRICE_FLOOR = {
+    "sqlite": "CAST({row}price AS INTEGER)",
+    "postgresql": "CAST(floor({row}price) AS BIGINT)",
+}
+FACET_COLUMNS = ("category", "color", "size", "available", "price")
+# The columns a JSON Merge Patch may change
+PATCHABLE_COLUMNS = (
+    "name", "sku", "available", "price", "stock", "size", "color", "category", "description",
+)
+
+
+def _facet_values(dialect, row):
+    """ Returns the SQL expression of every facet for a row prefix """
+    floor = PRICE_FLOOR[dialect].format(row=row)
+    return {name: expr.format(row=row, floor=floor) for name, expr in FACETS.items()}
+
+
+def _facet_upsert(dialect, row, sign):
+    """ Returns the statement adding sign times a row to its facet counts """
+    values = ",\n".join(
+        "('{}', {}, {sign}, CASE WHEN {row}price IS NULL THEN 0 ELSE {sign} END, "
+        "{sign} * coalesce({row}price, 0))".format(name, value, sign=sign, row=row)
+        for name, value in _facet_values(dialect, row).items()
+    )
+    table = "product_facet." if dialect == "postgresql" else ""
+    return (
+        "INSERT INTO product_facet (facet, value, count, priced, price_total) VALUES\n{values}\n"
+        "ON CONFLICT (facet, value) DO UPDATE SET count = {table}count + excluded.count, "
+        "priced = {table}priced + excluded.priced, "
+        "price_total = {table}price_total + excluded.price_total;"
+    ).format(values=values, table=table)
+
+
+def _chunks(items, size):
+    """ Splits a list into consecutive batches of at most size items """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
 class Product(db.Model):
     """
     Class that represents a product
     """
 
     app = None
+    cache = LRUCache()
+    fuzzy_search = None  # whether pg_trgm is installed, see has_fuzzy_search
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(63))
-    sku = db.Column(db.String(14))
+    name = db.Column(db.String(63), index=True)
+    sku = db.Column(db.String(14), unique=True, index=True)
     available = db.Column(db.Boolean())
     price = db.Column(db.Float)
     stock = db.Column(db.Integer)
@@ -35,7 +139,16 @@ class Product(db.Model):
     color = db.Column(db.String(10))
     category = db.Column(db.String(63))
     description = db.Column(db.String(250))
-    #lastUpdated = db.Column(db.String(10))#
+    # the catalog version of the last change, maintained by before_flush
+    # for ORM writes and by the Core statements of the bulk and stock methods
+    version = db.Column(db.BigInteger, nullable=False, default=0, server_default="0")
+    updated_at = db.Column(db.DateTime)
+
+    # category leads the composite index, so it also serves category-only lookups
+    __table_args__ = (
+        db.Index("ix_product_category_available", "category", "available"),
+        db.Index("ix_product_version", "version", "id"),
+    )
 
     def __repr__(self):
         return "<Product %r id=[%s]>" % (self.name, self.id)
@@ -48,6 +161,7 @@ class Product(db.Model):
         self.id = None  # id must be none to generate next primary key
         db.session.add(self)
         db.session.commit()
+        self.cache.delete(self.id)
 
     def save(self):
         """
@@ -55,12 +169,15 @@ class Product(db.Model):
         """
         logger.info("Saving %s", self.name)
         db.session.commit()
+        self.cache.delete(self.id)
 
     def delete(self):
         """ Removes a product from the data store """
         logger.info("Deleting %s", self.name)
+        product_id = self.id
         db.session.delete(self)
         db.session.commit()
+        self.cache.delete(product_id)
 
     def serialize(self):
         """ Serializes a product into a dictionary """
@@ -74,8 +191,9 @@ class Product(db.Model):
             "size": self.size,
             "color": self.color,
             "category": self.category,
-            "description": self.description#, Tabling for this sprint
-            #"lastUpdated": self.lastUpdated#
+            "description": self.description,
+            "version": self.version,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
 
     def deserialize(self, data):
@@ -95,7 +213,6 @@ class Product(db.Model):
             self.color = data["color"]
             self.category = data["category"]
             self.description = data["description"]
-            #self.lastUpdated = data["lastUpdated"]# Tabling for this sprint
 
         except KeyError as error:
             raise DataValidationError(
@@ -111,30 +228,762 @@ class Product(db.Model):
         """ Restocks a product in the database """
         self.stock = quant
         self.available = True
+        self._restocked = True  # published as a restock rather than an update
+        self.cache.delete(self.id)
         logger.info("Restocked {0}. There are now {1} available".format(self.name, self.stock))
 
+    @classmethod
+    def adjust_stock(cls, by_id, delta):
+        """
+        Atomically adds delta to the stock of a product in one UPDATE
+
+        The stock may not drop below zero, so concurrent decrements never
+        oversell and no row is read into Python first
+
+        Returns:
+            int: the new stock, or None if there is no such product or it
+                does not have enough stock
+        """
+        logger.info("Adjusting stock of %s by %s", by_id, delta)
+        stock = cls._update_stock(by_id, delta=delta)
+        db.session.commit()
+        cls.cache.delete(by_id)
+        return stock
+
+    @classmethod
+    def adjust_stock_many(cls, deltas):
+        """
+        Atomically applies many stock deltas in a single transaction
+
+        Either every delta is applied or, if any product is missing or
+        short of stock, none are. Rows are updated in id order so that
+        concurrent checkouts cannot deadlock on each other.
+
+        Args:
+            deltas (dict): product ids mapped to the delta to add to their stock
+
+        Returns:
+            tuple: a dict of the new stock by id, and the id that failed or None
+        """
+        logger.info("Adjusting stock of %s products", len(deltas))
+        stocks = {}
+        for by_id in sorted(deltas):
+            stock = cls._update_stock(by_id, delta=deltas[by_id])
+            if stock is None:
+                db.session.rollback()
+                return {}, by_id
+            stocks[by_id] = stock
+        db.session.commit()
+        cls.cache.delete(*stocks)
+        return stocks, None
+
+    @classmethod
+    def set_stock(cls, by_id, quantity):
+        """
+        Sets the stock of a product in one UPDATE and marks it available
+
+        Returns:
+            int: the new stock, or None if there is no such product
+        """
+        logger.info("Setting stock of %s to %s", by_id, quantity)
+        stock = cls._update_stock(by_id, quantity=quantity)
+        db.session.commit()
+        cls.cache.delete(by_id)
+        return stock
+
+    @classmethod
+    def _update_stock(cls, by_id, delta=None, quantity=None):
+        """ Runs UPDATE ... RETURNING stock without committing """
+        table = cls.__table__
+        version = cls.next_version()
+        stmt = table.update().where(table.c.id == by_id).values(
+            version=version, updated_at=datetime.utcnow()
+        )
+        if quantity is not None:
+            stmt = stmt.values(stock=quantity, available=True)
+        else:
+            new_stock = db.func.coalesce(table.c.stock, 0) + delta
+            stmt = stmt.where(new_stock >= 0).values(stock=new_stock)
+            if delta > 0:
+                stmt = stmt.values(available=True)
+        if db.engine.dialect.name == "postgresql":
+            row = db.session.execute(stmt.returning(table.c.stock)).fetchone()
+            stock = row[0] if row else None
+        # without RETURNING, read the row back inside the same transaction
+        elif db.session.execute(stmt).rowcount == 0:
+            stock = None
+        else:
+            stock = db.session.query(cls.stock).filter(cls.id == by_id).scalar()
+        if stock is not None:
+            op = "restock" if quantity is not None or delta > 0 else "update"
+            events.record(db.session, op, [by_id], version)
+        return stock
+
+    @classmethod
+    def patch(cls, by_id, changes):
+        """
+        Changes only the given fields of a product in one UPDATE ... RETURNING
+
+        The row is not read first and the other columns are left alone, so
+        concurrent patches of different fields do not undo each other
+
+        Args:
+            changes (dict): a JSON Merge Patch of the product, the fields to
+                change mapped to their new values, null to clear one
+
+        Returns:
+            dict: the serialized product, or None if there is no such product
+        """
+        values = cls.validate_patch(changes)
+        if not values:
+            # an empty patch changes nothing (RFC 7396)
+            data = cls.find_serialized(by_id)
+            db.session.rollback()  # ends the read, and the row lock of an If-Match
+            return data
+        logger.info("Patching %s of %s", ", ".join(sorted(values)), by_id)
+        table = cls.__table__
+        version = cls.next_version()
+        stmt = table.update().where(table.c.id == by_id).values(
+            version=version, updated_at=datetime.utcnow(), **values
+        )
+        if db.engine.dialect.name == "postgresql":
+            row = db.session.execute(stmt.returning(*table.c)).fetchone()
+        # without RETURNING, read the row back inside the same transaction
+        elif db.session.execute(stmt).rowcount:
+            row = db.session.execute(db.select(table.c).where(table.c.id == by_id)).fetchone()
+        else:
+            row = None
+        if row is None:
+            db.session.rollback()
+            return None
+        events.record(db.session, "update", [by_id], version)
+        db.session.commit()
+        cls.cache.delete(by_id)
+        data = dict(zip(row.keys(), row))
+        data["updated_at"] = data["updated_at"].isoformat()
+        return data
+
+    @classmethod
+    def validate_patch(cls, changes):
+        """ Checks the fields of a JSON Merge Patch against their columns
+
+        Returns:
+            dict: the column values to set, none for the empty patch {}
+        """
+        if not isinstance(changes, dict):
+            raise DataValidationError("Invalid patch: body must be a JSON object of fields")
+        values = {}
+        for name, value in changes.items():
+            if name not in PATCHABLE_COLUMNS:
+                raise DataValidationError("Invalid patch: {} cannot be changed".format(name))
+            values[name] = value
+            if value is None:
+                continue
+            column = cls.__table__.c[name]
+            python_type = column.type.python_type
+            if python_type is float:
+                valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+            elif python_type is int:
+                valid = isinstance(value, int) and not isinstance(value, bool)
+            else:
+                valid = isinstance(value, python_type)
+            if not valid:
+                raise DataValidationError(
+                    "Invalid patch: {} must be a {}".format(name, python_type.__name__)
+                )
+            length = getattr(column.type, "length", None)
+            if length and len(value) > length:
+                raise DataValidationError(
+                    "Invalid patch: {} is longer than {} characters".format(name, length)
+                )
+        return values
+
     @classmethod
     def init_db(cls, app):
-        """ Initializes the database session """
+        """ Initializes the database session
+
+        DB_SCHEMA decides when the tables are created: eager right away,
+        lazy before the first request and skip never (e.g. when the
+        deployment runs flask products create-schema once instead)
+        """
         logger.info("Initializing database")
         cls.app = app
+        cls.fuzzy_search = None
+        cls.cache = make_cache(app.config)
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
+        binds = replica_binds(app.config)
+        app.config["SQLALCHEMY_BINDS"] = dict(app.config.get("SQLALCHEMY_BINDS") or {}, **binds)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
-        app.app_context().push()
+        if binds:
+            app.extensions["replicas"] = ReplicaSet(
+                [db.get_engine(app, bind=key) for key in binds],
+                app.config.get("REPLICA_CHECK_SECONDS", 5),
+            )
+        events.init_events(app, db.get_engine(app))
+        schema = app.config.get("DB_SCHEMA", "eager")
+        if schema == "eager":
+            with app.app_context():
+                cls.create_schema()
+        elif schema == "lazy" and cls.create_schema not in app.before_first_request_funcs:
+            app.before_first_request(cls.create_schema)
+
+    @classmethod
+    def create_schema(cls):
+        """ Creates the tables and indexes that are missing """
+        logger.info("Creating the database schema")
         db.create_all()  # make our sqlalchemy tables
+        cls.create_missing_columns()
+        cls.create_missing_indexes()
+
+    @classmethod
+    def create_missing_columns(cls):
+        """
+        Adds the columns declared on the model that an existing table lacks
+
+        Like the indexes, columns declared after a database was created are
+        not added by create_all(). They are added with their server default
+        so existing rows get a value.
+        """
+        existing = {column["name"] for column in inspect(db.engine).get_columns(cls.__tablename__)}
+        for column in cls.__table__.columns:
+            if column.name in existing:
+                continue
+            logger.info("Adding missing column %s", column.name)
+            ddl = "ALTER TABLE {} ADD COLUMN {} {}".format(
+                cls.__tablename__, column.name, column.type.compile(db.engine.dialect))
+            if column.server_default is not None:
+                ddl += " DEFAULT {} NOT NULL".format(column.server_default.arg)
+            db.engine.execute(ddl)
+
+    @classmethod
+    def create_missing_indexes(cls):
+        """
+        Creates the indexes declared on the model that an existing table lacks
+
+        create_all() only creates missing tables, so databases made before an
+        index was declared are migrated here. On Postgres the indexes are built
+        with CREATE INDEX CONCURRENTLY so writes are not blocked meanwhile.
+        """
+        existing = {index["name"] for index in inspect(db.engine).get_indexes(cls.__tablename__)}
+        concurrently = db.engine.dialect.name == "postgresql"
+        for index in cls.__table__.indexes:
+            if index.name in existing:
+                continue
+            logger.info("Creating missing index %s", index.name)
+            index.dialect_options["postgresql"]["concurrently"] = concurrently
+            try:
+                # CONCURRENTLY cannot run inside a transaction block
+                with db.engine.connect() as conn:
+                    index.create(conn.execution_options(isolation_level="AUTOCOMMIT"))
+            except SQLAlchemyError as error:
+                logger.error("Could not create index %s: %s", index.name, error)
+                if concurrently:
+                    # a failed concurrent build leaves an invalid index behind
+                    db.engine.execute("DROP INDEX IF EXISTS {}".format(index.name))
+            finally:
+                index.dialect_options["postgresql"]["concurrently"] = False
+        if concurrently:
+            cls._create_search_indexes()
 
     @classmethod
-    def all(cls):
+    def _create_search_indexes(cls):
+        """ Creates the full text and trigram indexes used by select_search """
+        with db.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            trigram = True
+            try:
+                conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            except SQLAlchemyError as error:
+                trigram = False
+                logger.error("pg_trgm is not available, search will not be fuzzy: %s", error)
+            # only valid indexes count, an interrupted build has to start over
+            valid = {row[0] for row in conn.execute(
+                "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE i.indrelid = %s::regclass AND i.indisvalid",
+                (cls.__tablename__,),
+            )}
+            for name, definition in POSTGRES_INDEXES.items():
+                if name in valid or (name.endswith("_trgm") and not trigram):
+                    continue
+                logger.info("Creating missing index %s", name)
+                try:
+                    conn.execute("DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+                    conn.execute("CREATE INDEX CONCURRENTLY {} ON {} {}".format(
+                        name, cls.__tablename__, definition))
+                except SQLAlchemyError as error:
+                    logger.error("Could not create index %s: %s", name, error)
+
+    @classmethod
+    def create_many(cls, products, batch_size=1000):
+        """
+        Creates many products with one INSERT and one commit per batch
+
+        A product whose SKU is already taken, by a stored product or an
+        earlier one of the list, is skipped instead of failing its batch
+
+        Args:
+            products (list): the new Product instances, which are given ids
+            batch_size (int): the number of products written per transaction
+
+        Returns:
+            list: the products that were skipped for their SKU, without an id
+        """
+        logger.info("Bulk creating %s products", len(products))
+        conflicts = []
+        for batch in _chunks(products, batch_size):
+            conflicts += cls._retry_on_conflict(lambda: cls._insert_batch(batch))
+        return conflicts
+
+    @classmethod
+    def _insert_batch(cls, batch):
+        """ Inserts the products of a batch whose SKU is free and commits them """
+        table = cls.__table__
+        for product in batch:
+            product.id = None
+        conflicts = cls._taken_skus(batch)
+        skipped = set(conflicts)
+        batch = [product for product in batch if product not in skipped]
+        if not batch:
+            return conflicts
+        version, now = cls.next_version(), datetime.utcnow()
+        for product in batch:
+            product.version, product.updated_at = version, now
+        if db.engine.dialect.name == "postgresql":
+            # reserve the ids up front so the rows can go out as one executemany
+            ids = db.session.execute(
+                "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                "FROM generate_series(1, :count)",
+                {"table": table.name, "count": len(batch)},
+            )
+            rows = []
+            for product, (new_id,) in zip(batch, ids):
+                product.id = new_id
+                rows.append(dict(product.serialize(), updated_at=now))
+            db.session.execute(table.insert(), rows)
+        else:
+            db.session.bulk_save_objects(batch, return_defaults=True)
+        events.record(db.session, "create", [product.id for product in batch], version)
+        db.session.commit()
+        return conflicts
+
+    @classmethod
+    def update_many(cls, products, batch_size=1000):
+        """
+        Updates many existing products with one commit per batch
+
+        A product given a SKU that another product already has is skipped
+        instead of failing its batch
+
+        Args:
+            products (list): Product instances whose id names the row to update
+            batch_size (int): the number of products written per transaction
+
+        Returns:
+            tuple: the set of ids of the products that existed and were
+                updated, and the list of products skipped for their SKU
+        """
+        logger.info("Bulk updating %s products", len(products))
+        updated, conflicts = set(), []
+        for batch in _chunks(products, batch_size):
+            written, skipped = cls._retry_on_conflict(lambda: cls._update_batch(batch))
+            cls.cache.delete(*written)
+            updated |= written
+            conflicts += skipped
+        return updated, conflicts
+
+    @classmethod
+    def _update_batch(cls, batch):
+        """ Updates the products of a batch that exist and keep a free SKU and commits them """
+        ids = [product.id for product in batch]
+        found = {row.id for row in db.session.query(cls.id).filter(cls.id.in_(ids))}
+        batch = [product for product in batch if product.id in found]
+        conflicts = cls._taken_skus(batch)
+        skipped = set(conflicts)
+        batch = [product for product in batch if product not in skipped]
+        written = {product.id for product in batch}
+        if not batch:
+            return written, conflicts
+        version, now = cls.next_version(), datetime.utcnow()
+        db.session.bulk_update_mappings(cls, [
+            dict(product.serialize(), version=version, updated_at=now) for product in batch
+        ])
+        events.record(db.session, "update", written, version)
+        db.session.commit()
+        return written, conflicts
+
+    @classmethod
+    def _taken_skus(cls, batch):
+        """ Returns the products of a batch whose SKU belongs to another product
+
+        Both the stored products and the ones earlier in the batch count,
+        so the unique index on sku never fails the write of the batch
+        """
+        skus = {product.sku for product in batch if product.sku is not None}
+        owners = dict(db.session.query(cls.sku, cls.id).filter(cls.sku.in_(skus))) if skus else {}
+        conflicts = []
+        for product in batch:
+            if product.sku is None:
+                continue
+            # a new product has no id yet, it is its own claim
+            claimant = product if product.id is None else product.id
+            if owners.setdefault(product.sku, claimant) != claimant:
+                conflicts.append(product)
+        return conflicts
+
+    @staticmethod
+    def _retry_on_conflict(write):
+        """ Runs the write of a batch again if a concurrent one took its SKUs meanwhile """
+        try:
+            return write()
+        except IntegrityError:
+            db.session.rollback()
+            return write()
+
+    @classmethod
+    def delete_many(cls, ids, batch_size=1000):
+        """
+        Deletes many products with one DELETE and one commit per batch
+
+        Args:
+            ids (list): the ids of the products to delete
+            batch_size (int): the number of products deleted per transaction
+
+        Returns:
+            set: the ids of the products that existed and were deleted
+        """
+        logger.info("Bulk deleting %s products", len(ids))
+        deleted = set()
+        for batch in _chunks(ids, batch_size):
+            found = {row.id for row in db.session.query(cls.id).filter(cls.id.in_(batch))}
+            if found:
+                version = cls.next_version()
+                cls._bury(list(found), version, datetime.utcnow())
+                events.record(db.session, "delete", found, version)
+            cls.query.filter(cls.id.in_(found)).delete(synchronize_session=False)
+            db.session.commit()
+            cls.cache.delete(*found)
+            deleted |= found
+        return deleted
+
+    @classmethod
+    def paginate(cls, query, limit=None, after=None):
+        """ Restricts a query to one keyset page ordered by id
+
+        Args:
+            query (Query): the query to restrict
+            limit (int): the maximum number of products in the page
+            after (int): only return products with an id greater than this
+        """
+        query = query.order_by(cls.id)
+        if after is not None:
+            query = query.filter(cls.id > after)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def find_by_query(cls, filters=None, sort=None, fields=None, limit=None, after=None):
+        """ Returns all products matching every one of the given filters
+
+        Args:
+            filters (dict): column names mapped to the value they must equal,
+                or suffixed with _min / _max for an inclusive numeric range
+            sort (list): column names to order by, prefixed with - for descending
+            fields (list): the only columns to select; the results are then
+                named tuples that always include the id instead of Products
+            limit (int): the maximum number of products to return
+            after (int): only return products with an id greater than this
+        """
+        logger.info("Processing query for %s ...", filters)
+        if fields:
+            query = db.session.query(*cls._columns(fields))
+        else:
+            query = cls.query
+        query = query.filter(*cls._criteria(filters)).order_by(*cls._ordering(sort))
+        return cls.paginate(query, limit, after)
+
+    @classmethod
+    def select_rows(cls, filters=None, sort=None, fields=None, limit=None, after=None):
+        """ Returns a Core SELECT of the product columns matching the filters
+
+        Takes the same arguments as find_by_query, but the statement skips
+        the ORM: executing it yields plain row tuples whose columns are
+        named by the statement's c.keys(), with the id always first
+        """
+        logger.info("Processing row query for %s ...", filters)
+        stmt = db.select(cls._columns(fields)).order_by(*cls._ordering(sort))
+        criteria = cls._criteria(filters)
+        if after is not None:
+            criteria.append(cls.__table__.c.id > after)
+        if criteria:
+            stmt = stmt.where(db.and_(*criteria))
+        stmt = stmt.order_by(cls.__table__.c.id)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    @classmethod
+    def list_version(cls, filters=None, sort=None, limit=None, after=None):
+        """ Returns the page_version of the page select_rows would return
+
+        Aggregates the ids and versions of the page in the database, so a
+        page can be validated without reading its rows. Only the page is
+        scanned, as far as its LIMIT
+        """
+        page = cls.select_rows(filters, sort, ["version"], limit, after).alias("page")
+        stmt = db.select([
+            db.func.count(page.c.id), db.func.sum(page.c.id),
+            db.func.max(page.c.version), db.func.sum(page.c.version),
+        ])
+        return tuple(None if value is None else int(value)
+                     for value in db.session.execute(stmt).fetchone())
+
+    @staticmethod
+    def page_version(names, rows):
+        """ Returns the (count, id total, highest version, version total) of
+        the fetched rows of a page that selected the id and version
+
+        Every write stamps its products with a new version, so this changes
+        whenever a product enters, leaves or changes in the page. The version
+        total catches a Postgres transaction that committed after one with a
+        higher version
+        """
+        if not rows:
+            return (0, None, None, None)
+        index = names.index("version")
+        versions = [row[index] for row in rows]
+        return (len(rows), sum(row[0] for row in rows), max(versions), sum(versions))
+
+    @classmethod
+    def select_search(cls, text, limit=None, offset=0, dialect=None):
+        """ Returns a Core SELECT of the products best matching a free text search
+
+        On Postgres the name, description and category are matched with full
+        text search and, with pg_trgm, the name also by trigram similarity so
+        typos still match. Elsewhere every word is matched with LIKE. The rows
+        are the product columns followed by a score, best match first.
+
+        Args:
+            text (string): the words to search for
+            limit (int): the maximum number of products to return
+            offset (int): the number of best matches to skip
+            dialect (string): the database dialect, by default the engine's
+        """
+        logger.info("Processing search for %s ...", text)
+        table = cls.__table__
+        if not text.split():
+            raise DataValidationError("Invalid search: no words to search for")
+        if (dialect or db.engine.dialect.name) == "postgresql":
+            document = db.literal_column(SEARCH_DOCUMENT)
+            query = db.func.plainto_tsquery("english", text)
+            score = db.func.ts_rank(document, query)
+            match = document.op("@@")(query)
+            if cls.has_fuzzy_search():
+                score = score + db.func.similarity(table.c.name, text)
+                match = db.or_(match, table.c.name.op("%")(text))
+        else:
+            # a name match counts double, as in the weighting of ts_rank
+            score = db.literal(0)
+            for word in text.split():
+                pattern = "%{}%".format(
+                    word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                )
+                for column, weight in ((table.c.name, 2), (table.c.description, 1),
+                                       (table.c.category, 1)):
+                    score = score + db.case(
+                        [(column.ilike(pattern, escape="\\"), weight)], else_=0
+                    )
+            match = score > 0
+        stmt = db.select(list(table.columns) + [score.label("score")]).where(match)
+        stmt = stmt.order_by(db.desc("score"), table.c.id).offset(offset)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    @classmethod
+    def has_fuzzy_search(cls):
+        """ Checks if the pg_trgm extension is installed, asking the database once
+
+        It is looked up in pg_extension rather than remembered from
+        create_schema, which a worker with DB_SCHEMA=skip never runs
+        """
+        if cls.fuzzy_search is None:
+            installed = 0
+            if db.engine.dialect.name == "postgresql":
+                installed = db.session.execute(
+                    db.select([db.func.count()])
+                    .select_from(db.table("pg_extension"))
+                    .where(db.column("extname") == "pg_trgm")
+                ).scalar()
+            cls.fuzzy_search = bool(installed)
+            logger.info("Fuzzy search is %s", "on" if cls.fuzzy_search else "off")
+        return cls.fuzzy_search
+
+    @staticmethod
+    def fetch_rows(stmt):
+        """ Runs a SELECT from select_rows and returns all of its row tuples """
+        return [tuple(row) for row in db.session.execute(stmt)]
+
+    @staticmethod
+    def stream_rows(stmt, batch_size=1000):
+        """ Yields the row tuples of a SELECT without loading them all at once
+
+        Args:
+            stmt (Select): a statement from select_rows
+            batch_size (int): the number of rows fetched per round trip
+        """
+        logger.info("Streaming Product rows in batches of %s", batch_size)
+        # stream_results uses a server side cursor on Postgres
+        result = db.session.execute(stmt.execution_options(stream_results=True))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield tuple(row)
+
+    @classmethod
+    def _columns(cls, fields=None):
+        """ Returns the columns to select, the id first, or all of them """
+        if not fields:
+            return list(cls.__table__.columns)
+        names = ["id"] + [name for name in fields if name != "id"]
+        return [cls._column(name) for name in names]
+
+    @classmethod
+    def _criteria(cls, filters):
+        """ Returns the WHERE clauses of the filters of find_by_query """
+        criteria = []
+        for key, value in (filters or {}).items():
+            if key.endswith("_min") or key.endswith("_max"):
+                column = cls._column(key[:-4])
+                if column.type.python_type not in (int, float, datetime):
+                    raise DataValidationError("Invalid range filter: " + key)
+                value = cls._coerce(column, value)
+                criteria.append(column >= value if key.endswith("_min") else column <= value)
+            else:
+                column = cls._column(key)
+                criteria.append(column == cls._coerce(column, value))
+        return criteria
+
+    @classmethod
+    def _ordering(cls, sort):
+        """ Returns the ORDER BY clauses of the sort list of find_by_query """
+        ordering = []
+        for name in sort or []:
+            column = cls._column(name.lstrip("-"))
+            ordering.append(column.desc() if name.startswith("-") else column)
+        return ordering
+
+    @classmethod
+    def _column(cls, name):
+        """ Returns the table column with the given name """
+        column = cls.__table__.columns.get(name)
+        if column is None:
+            raise DataValidationError("Invalid Product field: " + name)
+        return column
+
+    @staticmethod
+    def _coerce(column, value):
+        """ Converts a query string value to the python type of a column """
+        python_type = column.type.python_type
+        if python_type is bool:
+            if value.lower() in ("true", "1", "yes"):
+                return True
+            if value.lower() in ("false", "0", "no"):
+                return False
+            raise DataValidationError("Invalid boolean for {}: {}".format(column.name, value))
+        if python_type is datetime:
+            python_type = datetime.fromisoformat
+        try:
+            return python_type(value)
+        except ValueError:
+            raise DataValidationError("Invalid value for {}: {}".format(column.name, value))
+
+    @classmethod
+    def all(cls, limit=None, after=None):
         """ Returns all of the products in the database """
         logger.info("Processing all Products")
-        return cls.query.all()
+        return cls.paginate(cls.query, limit, after).all()
 
     @classmethod
-    def find(cls, by_id):
-        """ Finds a product by its ID """
+    def find(cls, by_id, lock=False):
+        """ Finds a product by its ID
+
+        Args:
+            by_id (int): the id of the product to find
+            lock (bool): lock the row with SELECT ... FOR UPDATE until the
+                next commit, so it cannot change between a check and a write
+        """
         logger.info("Processing lookup for id %s ...", by_id)
+        if lock:
+            return cls.query.with_for_update().populate_existing().get(by_id)
         return cls.query.get(by_id)
 
+    @classmethod
+    def find_serialized(cls, by_id):
+        """ Returns the serialized product with the given id, or None
+
+        Reads through the product cache so hot products skip the database.
+        A product read from a replica may lag behind, so it is not cached.
+        """
+        data = cls.cache.get(by_id)
+        if data is None:
+            product = cls.find(by_id)
+            if product is None:
+                return None
+            data = product.serialize()
+            if not reading_from_replica():
+                cls.cache.set(by_id, data)
+        return data
+
+    @classmethod
+    def find_many_serialized(cls, ids, batch_size=500):
+        """ Returns the serialized products with the given ids
+
+        Reads through the product cache like find_serialized, and fetches
+        all of the misses with one SELECT ... WHERE id IN per batch_size ids
+
+        Returns:
+            dict: the serialized products that exist, by id
+        """
+        ids = list(dict.fromkeys(ids))
+        logger.info("Processing lookup for %s ids ...", len(ids))
+        found = cls.cache.get_many(ids)
+        missing = [by_id for by_id in ids if by_id not in found]
+        fetched = cls._fetch_serialized(cls.id, missing, batch_size)
+        if not reading_from_replica():
+            cls.cache.set_many(fetched)
+        found.update(fetched)
+        return found
+
+    @classmethod
+    def find_many_by_sku(cls, skus, batch_size=500):
+        """ Returns the serialized products with the given SKUs
+
+        The cache is keyed by id, so the products are read from the
+        database, then cached for the lookups by id
+
+        Returns:
+            dict: the serialized products that exist, by SKU
+        """
+        skus = list(dict.fromkeys(skus))
+        logger.info("Processing lookup for %s SKUs ...", len(skus))
+        fetched = cls._fetch_serialized(cls.sku, skus, batch_size)
+        if not reading_from_replica():
+            cls.cache.set_many(fetched)
+        return {data["sku"]: data for data in fetched.values()}
+
+    @classmethod
+    def _fetch_serialized(cls, column, keys, batch_size):
+        """ Serializes the products whose column is one of keys, by id """
+        fetched = {}
+        for batch in _chunks(keys, batch_size):
+            for product in cls.query.filter(column.in_(batch)):
+                fetched[product.id] = product.serialize()
+        return fetched
+
     @classmethod
     def find_or_404(cls, by_id):
         """ Find a product by its id """
@@ -142,26 +991,337 @@ class Product(db.Model):
         return cls.query.get_or_404(by_id)
 
     @classmethod
-    def find_by_name(cls, name):
+    def find_by_name(cls, name, limit=None, after=None):
         """ Returns all products with the given name
 
         Args:
             name (string): the name of the products you want to match
+            limit (int): the maximum number of products to return
+            after (int): only return products with an id greater than this
         """
         logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        return cls.paginate(cls.query.filter(cls.name == name), limit, after)
 
     @classmethod
-    def find_by_category(cls, category):
+    def find_by_category(cls, category, limit=None, after=None):
         """ Returns all products with the given category
 
         Args:
             name (string): the category of the products you want to match
+            limit (int): the maximum number of products to return
+            after (int): only return products with an id greater than this
         """
         logger.info("Processing category query for %s ...", category)
-        return cls.query.filter(cls.category == category)
+        return cls.paginate(cls.query.filter(cls.category == category), limit, after)
 
     @classmethod
     def remove_all(cls):
         """ Removes all documents from the database (use for testing)  """
+        ids = [row.id for row in db.session.query(cls.id)]
+        if ids:
+            version = cls.next_version()
+            cls._bury(ids, version, datetime.utcnow())
+            events.record(db.session, "delete", ids, version)
         cls.query.delete()
+        cls.cache.clear()
+
+    ##################################################
+    # CHANGE FEED
+    ##################################################
+
+    @classmethod
+    def next_version(cls, session=None):
+        """ Returns the catalog version of the current transaction
+
+        On Postgres it is the id of the transaction, which takes no lock, so
+        concurrent writers such as stock updates do not wait for each other.
+        Ids are handed out in start order, not commit order, so changes()
+        stops short of the oldest transaction still running. Elsewhere the
+        first call of a transaction increments the catalog_version row,
+        which stays locked until the commit, so writers take their versions
+        in commit order.
+        """
+        session = session or db.session
+        if "catalog_version" in session.info:
+            return session.info["catalog_version"]
+        if db.engine.dialect.name == "postgresql":
+            # text, not a SELECT a replica could serve
+            version = session.execute("SELECT txid_current()").scalar()
+            session.info["catalog_version"] = version
+            return version
+        table = catalog_version
+        stmt = table.update().where(table.c.id == 1).values(value=table.c.value + 1)
+        if session.execute(stmt).rowcount:
+            row = session.execute(db.select([table.c.value]).where(table.c.id == 1)).fetchone()
+        else:
+            row = None
+        if row is None:  # the first write ever
+            session.execute(table.insert().values(id=1, value=1))
+            row = (1,)
+        session.info["catalog_version"] = row[0]
+        return row[0]
+
+    @staticmethod
+    def _bury(ids, version, deleted_at, session=None):
+        """ Records tombstones for deleted products
+
+        Args:
+            ids (list): the ids of the products being deleted
+        """
+        session = session or db.session
+        table = product_tombstone
+        # an id deleted before (SQLite reuses ids) keeps only its last tombstone
+        session.execute(table.delete().where(table.c.id.in_(ids)))
+        session.execute(table.insert(), [
+            {"id": by_id, "version": version, "deleted_at": deleted_at} for by_id in ids
+        ])
+
+    @classmethod
+    def changes(cls, since=(0, 0), limit=100):
+        """ Returns the products changed and deleted after a point in version order
+
+        Args:
+            since (tuple): the (version, id) of the last change already seen,
+                (0, 0) to start with the whole catalog
+            limit (int): the maximum number of changes to return
+
+        Returns:
+            list: (version, id, product) tuples, with product None for a delete
+        """
+        version, last_id = since
+        logger.info("Processing changes since version %s", version)
+        product_horizon, tombstone_horizon = cls._change_horizon()
+        products = (
+            cls.query.filter(db.or_(
+                cls.version > version, db.and_(cls.version == version, cls.id > last_id)
+            ), *product_horizon)
+            .order_by(cls.version, cls.id)
+            .limit(limit)
+            .all()
+        )
+        table = product_tombstone
+        tombstones = db.session.execute(
+            db.select([table.c.version, table.c.id])
+            .where(db.and_(db.or_(
+                table.c.version > version,
+                db.and_(table.c.version == version, table.c.id > last_id),
+            ), *tombstone_horizon))
+            .order_by(table.c.version, table.c.id)
+            .limit(limit)
+        ).fetchall()
+        changes = [(product.version, product.id, product) for product in products]
+        changes += [(row.version, row.id, None) for row in tombstones]
+        # a reused id may have a tombstone and a row in the same version,
+        # the delete goes first
+        changes.sort(key=lambda change: (change[0], change[1], change[2] is not None))
+        return changes[:limit]
+
+    @classmethod
+    def change_head(cls):
+        """ Returns the (version, id) of the last change changes() serves now
+
+        Starting from it, changes() returns only what is committed later, or
+        is not yet below the Postgres horizon; (0, 0) for an empty feed
+        """
+        product_horizon, tombstone_horizon = cls._change_horizon()
+        table = product_tombstone
+        heads = [
+            db.session.execute(
+                db.select([cls.version, cls.id]).where(db.and_(*product_horizon))
+                .order_by(cls.version.desc(), cls.id.desc()).limit(1)
+            ).fetchone(),
+            db.session.execute(
+                db.select([table.c.version, table.c.id]).where(db.and_(*tombstone_horizon))
+                .order_by(table.c.version.desc(), table.c.id.desc()).limit(1)
+            ).fetchone(),
+        ]
+        return max([tuple(head) for head in heads if head is not None], default=(0, 0))
+
+    @classmethod
+    def _change_horizon(cls):
+        """ Returns the WHERE clauses keeping changes() to the committed versions """
+        if db.engine.dialect.name != "postgresql":
+            return [], []
+        # every transaction below the oldest one still running has ended,
+        # so no change with a lower version can be committed after the
+        # read; each statement takes the horizon of its own snapshot
+        horizon = db.func.txid_snapshot_xmin(db.func.txid_current_snapshot())
+        return [cls.version < horizon], [product_tombstone.c.version < horizon]
+
+    ##################################################
+    # FACETS
+    ##################################################
+
+    @staticmethod
+    def rebuild_facets(connection=None):
+        """ Recounts product_facet from the products with one GROUP BY per facet
+
+        The triggers keep the counts up to date, this is for a database
+        that had products before them. On Postgres writes wait meanwhile,
+        so the connection must be in a transaction until the counts commit.
+        """
+        logger.info("Rebuilding the product facets")
+        connection = connection or db.session
+        dialect = getattr(connection, "dialect", db.engine.dialect).name
+        if dialect == "postgresql":
+            connection.execute("LOCK TABLE product IN SHARE MODE")
+        connection.execute(product_facet.delete())
+        for name, value in _facet_values(dialect, "").items():
+            connection.execute(
+                "INSERT INTO product_facet (facet, value, count, priced, price_total) "
+                "SELECT '{}', {value}, count(*), count(price), coalesce(sum(price), 0) "
+                "FROM product GROUP BY {value}".format(name, value=value)
+            )
+
+    @staticmethod
+    def facet_counts():
+        """ Returns the counted values of every facet
+
+        Returns:
+            dict: facet names mapped to lists of (value, count, priced,
+                price_total) tuples, where priced counts the products with
+                a price, values with no products left out
+        """
+        logger.info("Processing product facets")
+        table = product_facet
+        rows = db.session.execute(
+            db.select([table.c.facet, table.c.value, table.c.count, table.c.priced,
+                       table.c.price_total])
+            .where(table.c.count > 0)
+            .order_by(table.c.facet, table.c.count.desc(), table.c.value)
+        )
+        facets = {name: [] for name in FACETS}
+        for row in rows:
+            facets[row.facet].append((row.value, row.count, row.priced, row.price_total))
+        return facets
+
+
+@event.listens_for(db.session, "before_flush")
+def _stamp_versions(session, flush_context, instances):
+    """ Stamps the products an ORM flush writes and buries the deleted ones """
+    changed = [obj for obj in session.new if isinstance(obj, Product)]
+    changed += [
+        obj for obj in session.dirty if isinstance(obj, Product) and session.is_modified(obj)
+    ]
+    deleted = [obj for obj in session.deleted if isinstance(obj, Product)]
+    if not changed and not deleted:
+        return
+    version, now = Product.next_version(session), datetime.utcnow()
+    for product in changed:
+        product.version, product.updated_at = version, now
+    if deleted:
+        Product._bury([product.id for product in deleted], version, now, session)
+
+
+@event.listens_for(db.session, "after_flush")
+def _record_events(session, flush_context):
+    """ Records the events of the products an ORM flush wrote """
+    version = session.info.get("catalog_version")
+    if version is None:
+        return
+    ops = {"create": [], "update": [], "restock": [], "delete": []}
+    for obj in session.new:
+        if isinstance(obj, Product):
+            ops["create"].append(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Product) and session.is_modified(obj):
+            ops["restock" if obj.__dict__.pop("_restocked", False) else "update"].append(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Product):
+            ops["delete"].append(obj.id)
+    for op, ids in ops.items():
+        events.record(session, op, ids, version)
+
+
+@event.listens_for(db.session, "after_commit")
+def _publish_events(session):
+    """ Publishes the events of a committed transaction """
+    events.committed(session)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_events(session):
+    """ Drops the events of a transaction that was rolled back """
+    events.discard(session)
+
+
+@event.listens_for(db.session, "after_commit")
+@event.listens_for(db.session, "after_rollback")
+def _forget_version(session):
+    """ Lets the next transaction take a new catalog version """
+    session.info.pop("catalog_version", None)
+
+
+@event.listens_for(db.Model.metadata, "after_create")
+def _create_facet_triggers(metadata, connection, **kw):
+    """ Creates the triggers that keep product_facet up to date
+
+    They run on every write to product, the Core bulk and stock statements
+    included. When they were missing the counts are rebuilt from scratch.
+    """
+    if has_app_context() and connection.engine is not db.get_engine():
+        return  # create_all() of a replica bind, which gets them from the primary
+    dialect = connection.dialect.name
+    if dialect not in PRICE_FLOOR:
+        logger.warning("No product facet triggers for %s", dialect)
+        return
+    # one transaction, so on Postgres writes wait until the triggers are
+    # in place and the counts rebuilt, and none is counted twice or missed
+    with connection.begin():
+        distinct = "IS DISTINCT FROM" if dialect == "postgresql" else "IS NOT"
+        changed = " OR ".join(
+            "OLD.{0} {1} NEW.{0}".format(column, distinct) for column in FACET_COLUMNS
+        )
+        update_of = ", ".join(FACET_COLUMNS)
+        if dialect == "postgresql":
+            # also makes a worker creating the schema at the same time wait
+            connection.execute("LOCK TABLE product IN SHARE ROW EXCLUSIVE MODE")
+            existing = {row[0] for row in connection.execute(
+                "SELECT tgname FROM pg_trigger WHERE tgrelid = 'product'::regclass"
+            )}
+            connection.execute(
+                "CREATE OR REPLACE FUNCTION product_facets_count() RETURNS trigger AS $$\n"
+                "BEGIN\n"
+                "IF TG_OP <> 'INSERT' THEN\n{}\nEND IF;\n"
+                "IF TG_OP <> 'DELETE' THEN\n{}\nEND IF;\n"
+                "RETURN NULL;\n"
+                "END $$ LANGUAGE plpgsql".format(
+                    _facet_upsert(dialect, "OLD.", -1), _facet_upsert(dialect, "NEW.", 1)
+                )
+            )
+            count = "FOR EACH ROW {}EXECUTE PROCEDURE product_facets_count()"
+            triggers = {
+                "product_facets_write": "AFTER INSERT OR DELETE ON product " + count.format(""),
+                "product_facets_update": "AFTER UPDATE OF {} ON product {}".format(
+                    update_of, count.format("WHEN ({}) ".format(changed))),
+            }
+        else:
+            existing = {row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'product'"
+            )}
+            triggers = {
+                "product_facets_insert": "AFTER INSERT ON product BEGIN\n{}\nEND".format(
+                    _facet_upsert(dialect, "NEW.", 1)),
+                "product_facets_delete": "AFTER DELETE ON product BEGIN\n{}\nEND".format(
+                    _facet_upsert(dialect, "OLD.", -1)),
+                "product_facets_update": "AFTER UPDATE OF {} ON product WHEN {} "
+                                         "BEGIN\n{}\n{}\nEND".format(
+                    update_of, changed,
+                    _facet_upsert(dialect, "OLD.", -1), _facet_upsert(dialect, "NEW.", 1)),
+            }
+        columns = {column["name"] for column in inspect(connection).get_columns("product_facet")}
+        if "priced" not in columns:
+            # counted before products without a price were told apart
+            connection.execute(
+                "ALTER TABLE product_facet ADD COLUMN priced BIGINT DEFAULT 0 NOT NULL"
+            )
+            for name in existing.intersection(triggers):
+                connection.execute("DROP TRIGGER {}{}".format(
+                    name, " ON product" if dialect == "postgresql" else ""))
+            existing = set()
+        missing = [name for name in triggers if name not in existing]
+        for name in missing:
+            logger.info("Creating trigger %s", name)
+            connection.execute("CREATE TRIGGER {} {}".format(name, triggers[name]))
+        if missing:
+            Product.rebuild_facets(connection)
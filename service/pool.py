@@ -0,0 +1,71 @@
+"""
+Database Connection Pooling
+
+Builds the SQLAlchemy engine options from the DB_POOL_* settings in
+config.py and keeps the pool gauges the service publishes. With
+DB_PGBOUNCER set the service keeps no pool of its own and opens a
+connection per checkout, leaving the pooling to PgBouncer. psycopg2 never
+prepares statements server side, so there is no statement cache to turn off
+for PgBouncer's transaction pooling mode.
+"""
+
+import time
+import threading
+from sqlalchemy.pool import QueuePool, NullPool
+
+
+class TimedQueuePool(QueuePool):
+    """ A QueuePool that records how long checkouts wait for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._timing_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            with self._timing_lock:
+                self.checkouts += 1
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+def engine_options(config):
+    """ Returns the SQLAlchemy engine options for the configured database """
+    if config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return {}  # SQLite picks its own pool class
+    if config["DB_PGBOUNCER"]:
+        return {"poolclass": NullPool}
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+
+
+def pool_stats(pool):
+    """ Returns the gauges of a connection pool """
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+        )
+    if isinstance(pool, TimedQueuePool):
+        stats.update(
+            checkouts=pool.checkouts,
+            checkout_wait_seconds_total=pool.wait_seconds_total,
+            checkout_wait_seconds_max=pool.wait_seconds_max,
+        )
+    return stats
@@ -0,0 +1,118 @@
+"""
+SQL Profiling for the Products Service
+
+Opt-in instrumentation for finding out where a slow request spends its
+time. It is controlled by three settings in config.py:
+
+SQL_PROFILING - record every statement a request runs with its time and
+    row count, and log a summary of them when the request ends
+SLOW_QUERY_SECONDS - with SQL_PROFILING, log statements slower than this
+    together with the EXPLAIN plan the database chose for them
+SERVER_TIMING - add a Server-Timing header that splits the request into
+    its db, orm, serialize, jsonify and compress phases
+"""
+
+import time
+import logging
+from flask import g, request, current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger("flask.app")
+
+# phases reported in Server-Timing besides db and the total
+PHASES = ("orm", "serialize", "jsonify", "compress")
+
+
+def init_profiling(app):
+    """ Adds the profiling hooks to the app and every SQLAlchemy engine """
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _profiling():
+    """ Checks if statements of the current request should be recorded """
+    return (
+        has_app_context()
+        and current_app.config.get("SQL_PROFILING")
+        and "sql_statements" in g
+    )
+
+
+def _start_request():
+    g.sql_statements = []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _profiling():
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not _profiling() or not conn.info.get("profile_start"):
+        return
+    elapsed = time.perf_counter() - conn.info["profile_start"].pop()
+    rows = cursor.rowcount if cursor.rowcount >= 0 else None
+    g.sql_statements.append(
+        {"statement": statement, "seconds": elapsed, "rows": rows}
+    )
+    threshold = current_app.config.get("SLOW_QUERY_SECONDS")
+    if threshold is not None and elapsed >= threshold:
+        logger.warning(
+            "Slow query (%.1f ms, %s rows): %s\n%s",
+            elapsed * 1000, rows, statement, explain(conn, cursor, statement, parameters),
+        )
+
+
+def explain(conn, cursor, statement, parameters):
+    """ Returns the plan the database chose for a SELECT statement """
+    # executemany batches and writes have no plan worth running on their own
+    if isinstance(parameters, list) or not statement.lstrip().upper().startswith("SELECT"):
+        return "(no plan for this statement)"
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    # use a fresh DBAPI cursor so the explain is neither profiled nor
+    # mixed up with the rows of the statement that was just run
+    plan_cursor = cursor.connection.cursor()
+    try:
+        plan_cursor.execute(prefix + statement, parameters)
+        return "\n".join(" ".join(str(col) for col in row) for row in plan_cursor.fetchall())
+    except Exception as error:  # the plan is a debugging aid, never fail the request
+        return "(could not explain: {})".format(error)
+    finally:
+        plan_cursor.close()
+
+
+def _finish_request(response):
+    if "metrics_start" not in g:
+        return response
+    config = current_app.config
+    if config.get("SQL_PROFILING"):
+        statements = g.get("sql_statements", [])
+        logger.info(
+            "%s %s ran %d queries in %.1f ms returning %d rows",
+            request.endpoint or request.path, response.status_code, len(statements),
+            sum(item["seconds"] for item in statements) * 1000,
+            sum(item["rows"] or 0 for item in statements),
+        )
+        for item in statements:
+            logger.debug("%.1f ms %s", item["seconds"] * 1000, item["statement"])
+    if config.get("SERVER_TIMING"):
+        response.headers["Server-Timing"] = server_timing()
+    return response
+
+
+def server_timing():
+    """ Builds the Server-Timing header value of the current request """
+    phases = dict(g.phase_seconds)
+    # the orm phase ran the SQL too, so report only its own share
+    if "orm" in phases:
+        phases["orm"] = max(phases["orm"] - g.db_seconds, 0.0)
+    metrics = ['db;dur={:.2f};desc="{} queries"'.format(g.db_seconds * 1000, g.db_queries)]
+    for phase in PHASES:
+        if phase in phases:
+            metrics.append("{};dur={:.2f}".format(phase, phases[phase] * 1000))
+    metrics.append("total;dur={:.2f}".format((time.perf_counter() - g.metrics_start) * 1000))
+    return ", ".join(metrics)
@@ -0,0 +1,234 @@
+"""
+Read Replica Routing
+
+With DATABASE_REPLICA_URIS set in config.py, the SELECTs of GET and HEAD
+requests (Product.all, find, find_by_* and the list and search queries)
+and of the views marked read_only, like POST /products/lookup, are sent to
+the replicas in turn, while every write, every locking read and every other
+request goes to the primary. A replica that fails its health check is
+skipped until it passes again, and when none is healthy the reads fall
+back to the primary. A request reads one replica for all of its SELECTs, so
+its queries see the same point in time even when the replicas lag by
+different amounts.
+
+Replicas lag behind the primary, so a successful write sets a short lived
+cookie (REPLICA_STICKY_SECONDS) that keeps the reads of that client on the
+primary until the replicas have caught up: clients see their own writes.
+The rows read from a replica are not put in the shared product cache, which
+the cookie cannot route, so a lagging row never outlives the lag.
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from flask import g, request, current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import Select
+
+logger = logging.getLogger("flask.app")
+
+STICKY_COOKIE = "products_primary_until"
+READ_METHODS = ("GET", "HEAD")
+
+
+def replica_binds(config):
+    """ Returns the Flask-SQLAlchemy binds of the configured replicas """
+    return {
+        "replica{}".format(number): uri
+        for number, uri in enumerate(config.get("DATABASE_REPLICA_URIS") or [])
+    }
+
+
+class ReplicaSet:
+    """ Hands out healthy replica engines round robin """
+
+    def __init__(self, engines, check_seconds=5):
+        self.engines = list(engines)
+        self.check_seconds = check_seconds
+        self._next = 0
+        self._status = {}  # engine -> (healthy, checked at)
+        self._reads = {}
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            self._watch(engine)
+
+    def _watch(self, engine):
+        """ Takes a replica out of rotation as soon as it drops a connection """
+        def on_error(context):
+            if context.is_disconnect:
+                self.mark_down(engine)
+        event.listen(engine, "handle_error", on_error)
+
+    def pick(self):
+        """ Returns the next healthy replica, or None to use the primary
+
+        Counted as a read of that replica; a request picks one for all its reads
+        """
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % max(len(self.engines), 1)
+        for offset in range(len(self.engines)):
+            engine = self.engines[(start + offset) % len(self.engines)]
+            if self.healthy(engine):
+                with self._lock:
+                    self._reads[engine] = self._reads.get(engine, 0) + 1
+                return engine
+        return None
+
+    def healthy(self, engine):
+        """ Checks a replica, asking it again once the last check is stale """
+        healthy, checked_at = self._status.get(engine, (False, None))
+        now = time.monotonic()
+        if checked_at is not None and now - checked_at < self.check_seconds:
+            return healthy
+        healthy = self.ping(engine)
+        if not healthy and self._status.get(engine, (True, None))[0]:
+            logger.warning("Replica %s is down, reading from the others", engine.url)
+        self._status[engine] = (healthy, now)
+        return healthy
+
+    def mark_down(self, engine):
+        """ Skips a replica until its next health check """
+        self._status[engine] = (False, time.monotonic())
+
+    @staticmethod
+    def ping(engine):
+        """ Runs a trivial query on a replica """
+        try:
+            with engine.connect() as conn:
+                conn.execute("SELECT 1")
+            return True
+        except SQLAlchemyError:
+            return False
+
+    def stats(self):
+        """ Returns the health and read count of every replica """
+        return [
+            {
+                "url": repr(engine.url),  # repr hides the password
+                "healthy": self._status.get(engine, (None, None))[0],
+                "reads": self._reads.get(engine, 0),
+            }
+            for engine in self.engines
+        ]
+
+
+class RoutingSession(SignallingSession):
+    """ A session that sends plain SELECTs to a replica when reads allow it """
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.extensions.get("replicas")
+        if replicas and reading_from_replica():
+            if _replica_safe(clause):
+                if "replica" not in g:
+                    g.replica = replicas.pick()  # None reads the primary
+                if g.replica is not None:
+                    return g.replica
+            elif clause is not None:
+                read_from_primary()  # a write, read it back from the primary
+        return super().get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _after_flush(session, flush_context):
+    # the objects just written are refreshed from the primary
+    read_from_primary()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with read replica routing """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _replica_safe(clause):
+    """ Checks if a statement only reads and takes no locks """
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+def reading_from_replica():
+    """ Checks if the current reads may be served by a replica """
+    return (
+        has_app_context()
+        and bool(current_app.extensions.get("replicas"))
+        and g.get("read_replica", False)
+    )
+
+
+def read_from_primary():
+    """ Sends the rest of the current reads to the primary """
+    if reading_from_replica():
+        g.read_replica = False
+
+
+@contextmanager
+def replica_reads():
+    """ Lets the reads in the block go to a replica, e.g. in a report job
+
+    Once the block writes, the rest of its reads go to the primary
+    """
+    previous = g.get("read_replica", False)
+    picked = "replica" in g
+    replica = g.pop("replica", None)
+    g.read_replica = True
+    try:
+        yield
+    finally:
+        g.read_replica = previous
+        g.pop("replica", None)
+        if picked:
+            g.replica = replica
+
+
+def read_only(view):
+    """ Marks a view that only reads, though not with GET, e.g. a lookup by POST
+
+    Its reads may go to a replica, and it does not keep the client on the primary
+    """
+    view.read_only = True
+    return view
+
+
+def _read_only_request():
+    view = current_app.view_functions.get(request.endpoint)
+    return request.method in READ_METHODS or getattr(view, "read_only", False)
+
+
+def init_replicas(app):
+    """ Routes the reads of read only requests to the replicas """
+    app.before_request(_start_request)
+    app.after_request(_stick_to_primary)
+    app.teardown_request(_finish_request)
+
+
+def _start_request():
+    try:
+        sticky = float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        sticky = False
+    g.read_replica = _read_only_request() and not sticky
+
+
+def _finish_request(error=None):
+    # reads outside of a request go to the primary again
+    g.pop("read_replica", None)
+    g.pop("replica", None)
+
+
+def _stick_to_primary(response):
+    seconds = current_app.config.get("REPLICA_STICKY_SECONDS")
+    if (
+        current_app.extensions.get("replicas")
+        and seconds
+        and not _read_only_request()
+        and response.status_code < 400
+    ):
+        response.set_cookie(
+            STICKY_COOKIE, "{:.3f}".format(time.time() + seconds),
+            max_age=int(seconds) + 1, httponly=True,
+        )
+    return response
@@ -4,30 +4,111 @@ Products Service
 Paths:
 ------
 GET /products - Returns a list all of the products
+GET /products?limit={n}&after={cursor} - Returns one page of the products
+GET /products?stream=1 - Streams the products as newline delimited JSON
+GET /products?{field}={value}&sort={fields}&fields={fields} - Filters, sorts
+    and projects the products
+GET /products?ids={id},{id} - Returns the products with the given ids in that order
+POST /products/lookup - Returns the products with the given ids or SKUs in that order
+GET /products/facets - Returns the product counts per category, color, size, availability and price
+GET /products/stats - Returns the product count, availability and average price of the catalog
+GET /products/search?q={text} - Returns the products best matching a free text search
+GET /products/changes?since={token} - Returns the products changed or deleted since a change token
+GET /products/changes?since={token}&wait={seconds} - Long polls for the next changes
+GET /products/events - Streams the product events as server-sent events
 GET /products/{id} - Returns the product with a given id number
 POST /products - creates a new product record in the database
 PUT /products/{id} - updates a product record in the database
+PATCH /products/{id} - changes some fields of a product record with a JSON Merge Patch
 DELETE /products/{id} - deletes a product record in the database
+POST /products/bulk - creates many product records in batches
+PUT /products/bulk - updates many product records in batches
+DELETE /products/bulk - deletes many product records in batches
+POST /products/{id}/stock - atomically adjusts or sets the stock of a product
+POST /products/stock - atomically adjusts the stock of many products at once
+GET /products/cache - Returns the hit and miss counters of the product cache
+GET /products/pool - Returns the gauges of the database connection pools and replicas
+GET /metrics - Returns the request metrics in the Prometheus text format
 """
 
 
-from flask import jsonify, request, url_for, make_response
+import base64
+import binascii
+import hashlib
+import json
+import time
+from flask import Blueprint, current_app, jsonify, request, url_for, make_response, abort
+from flask import Response, stream_with_context
 from flask_api import status  # HTTP Status Codes
 from werkzeug.exceptions import NotFound
-from service.models import Product  # , DataValidationError
+from werkzeug.http import quote_etag
+from sqlalchemy.exc import IntegrityError
+from service.models import Product, DataValidationError, db
+from service.pool import pool_stats
+from service import encoding
+from service.metrics import init_metrics, render_metrics, timed_phase
+from service.profiling import init_profiling
+from service.replicas import init_replicas, read_from_primary, read_only
+from service.compression import init_compression
 
-# Import Flask application
-from . import app
+# The routes of the service, added to an app by init_app()
+api = Blueprint("products", __name__)
+
+NDJSON = "application/x-ndjson"
+MERGE_PATCH = "application/merge-patch+json"
+
+# Query string arguments of GET /products that are not column filters
+LIST_ARGS = ("limit", "after", "stream", "sort", "fields", "ids")
 
 ######################################################################
 # Error Handlers
 ######################################################################
+@api.app_errorhandler(status.HTTP_400_BAD_REQUEST)
+def bad_request(error):
+    """ Handles bad requests with 400_BAD_REQUEST """
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message),
+        status.HTTP_400_BAD_REQUEST,
+    )
+
+@api.app_errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """ Handles failed If-Match preconditions with 412_PRECONDITION_FAILED """
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        jsonify(
+            status=status.HTTP_412_PRECONDITION_FAILED,
+            error="Precondition Failed",
+            message=message,
+        ),
+        status.HTTP_412_PRECONDITION_FAILED,
+    )
+
+@api.app_errorhandler(DataValidationError)
+def request_validation_error(error):
+    """ Handles Value Errors from bad data """
+    return bad_request(error)
+
+@api.app_errorhandler(status.HTTP_409_CONFLICT)
+@api.app_errorhandler(IntegrityError)
+def conflict(error):
+    """ Handles writes that conflict with the stored data with 409_CONFLICT """
+    db.session.rollback()
+    message = str(getattr(error, "orig", error))
+    current_app.logger.warning(message)
+    return (
+        jsonify(status=status.HTTP_409_CONFLICT, error="Conflict", message=message),
+        status.HTTP_409_CONFLICT,
+    )
 
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
+@api.route("/")
 def index():
     """ Root URL response """
     # return (
@@ -38,61 +119,387 @@ def index():
     #     ),
     #     status.HTTP_200_OK,
     # )
-    return app.send_static_file('index.html')
+    return current_app.send_static_file('index.html')
 ######################################################################
 # LIST ALL products
 ######################################################################
-@app.route("/products", methods=["GET"])
+@api.route("/products", methods=["GET"])
 def list_products():
-    """ Returns all of the Products """
-    app.logger.info("Request for Product list")
-    products = []
-    category = request.args.get("category")
-    name = request.args.get("name")
-    if category:
-        products = Product.find_by_category(category)
-    elif name:
-        products = Product.find_by_name(name)
-    else:
-        products = Product.all()
+    """
+    Returns all of the Products
 
-    results = [product.serialize() for product in products]
-    return make_response(jsonify(results), status.HTTP_200_OK)
+    Any other query string argument filters on the product column of the
+    same name; price, stock and id also take _min / _max ranges. Pages are
+    PAGE_SIZE_DEFAULT long without limit, a stream has no page size
+    """
+    current_app.logger.info("Request for Product list")
+    if "ids" in request.args:
+        ids = []
+        for value in split_args("ids"):
+            try:
+                ids.append(int(value))
+            except ValueError:
+                abort(status.HTTP_400_BAD_REQUEST, "ids must be integers: {}".format(value))
+        return lookup_response("ids", ids)
+    filters = {
+        key: value
+        for key, value in request.args.items()
+        if key not in LIST_ARGS and value
+    }
+    sort = split_args("sort")
+    fields = split_args("fields")
+    limit, after = get_page_args()
+    if sort and after is not None:
+        abort(status.HTTP_400_BAD_REQUEST, "after can only be used with the default sort")
+    stream = wants_stream()
+    if not stream:
+        limit = limit or current_app.config["PAGE_SIZE_DEFAULT"]
+    # read plain rows with Core instead of hydrating Product objects
+    stmt = Product.select_rows(filters, sort, fields, limit, after)
+
+    if stream:
+        return stream_products(stmt)
+    mimetype = body_mimetype()
+    if request.if_none_match:
+        # an unchanged page is answered before any row is read
+        with timed_phase("orm"):
+            etag = list_etag(Product.list_version(filters, sort, limit, after), limit, mimetype)
+        if etag in request.if_none_match:
+            response = make_response("", status.HTTP_304_NOT_MODIFIED, {"ETag": quote_etag(etag)})
+            response.vary.add("Accept")
+            return response
+    names = stmt.c.keys()
+    if "version" not in names:
+        # fetch the version to tag the page, without sending it
+        stmt = Product.select_rows(filters, sort, fields + ["version"], limit, after)
+    with timed_phase("orm"):
+        rows = Product.fetch_rows(stmt)
+    with timed_phase("serialize"):
+        results = encoding.rows_to_dicts(names, rows)
+    with timed_phase("jsonify"):
+        body = encoding.dumps(results, mimetype)
+    response = make_response(body, status.HTTP_200_OK, {"Content-Type": mimetype})
+    response.vary.add("Accept")
+    if len(rows) == limit and not sort:
+        add_next_page_headers(response, rows[-1][0])
+    etag = list_etag(Product.page_version(stmt.c.keys(), rows), limit, mimetype)
+    response.set_etag(etag)
+    return response
+
+######################################################################
+# LOOK UP MANY PRODUCTS
+######################################################################
+@api.route("/products/lookup", methods=["POST"])
+@read_only
+def lookup_products():
+    """
+    Returns the products with the given ids or SKUs
+
+    The body is {"ids": [...]} or {"skus": [...]}. The products come back
+    in the order they were asked for, with null and an entry in missing
+    for the ones that do not exist.
+    """
+    current_app.logger.info("Request to look up products")
+    check_content_type("application/json")
+    data = request.get_json()
+    keys = [key for key in ("ids", "skus") if isinstance(data, dict) and key in data]
+    if len(keys) != 1:
+        raise DataValidationError("Invalid request: send either ids or skus")
+    values = data[keys[0]]
+    kind = int if keys[0] == "ids" else str
+    if not isinstance(values, list) or not all(
+        isinstance(value, kind) and not isinstance(value, bool) for value in values
+    ):
+        raise DataValidationError(
+            "Invalid request: {} must be a list of {}".format(keys[0], kind.__name__)
+        )
+    return lookup_response(keys[0], values)
+
+######################################################################
+# PRODUCT FACETS AND STATISTICS
+######################################################################
+@api.route("/products/facets", methods=["GET"])
+def list_facets():
+    """
+    Returns the product counts per category, color, size and availability
+
+    Values come most common first with the average price of their
+    products, and price is a histogram of price_bucket wide buckets. The
+    counts are read from the summary the database keeps, not the products.
+    """
+    width = request.args.get("price_bucket", current_app.config["FACET_PRICE_BUCKET"])
+    try:
+        width = int(width)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "price_bucket must be an integer")
+    if width < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "price_bucket must be a positive integer")
+    with timed_phase("orm"):
+        counts = Product.facet_counts()
+    results = {}
+    for facet in ("category", "color", "size", "available"):
+        results[facet] = [
+            {
+                "value": facet_value(facet, value),
+                "count": count,
+                "average_price": round(total / priced, 2) if priced else None,
+            }
+            for value, count, priced, total in counts[facet]
+        ]
+    buckets = {}
+    for value, count, _, _ in counts["price"]:
+        if value:  # products without a price are in no bucket
+            bucket = int(value) // width * width
+            buckets[bucket] = buckets.get(bucket, 0) + count
+    results["price"] = [
+        {"min": bucket, "max": bucket + width, "count": buckets[bucket]}
+        for bucket in sorted(buckets)
+    ]
+    return facets_response(results)
+
+@api.route("/products/stats", methods=["GET"])
+def get_stats():
+    """ Returns the product count, availability and average price of the catalog """
+    with timed_phase("orm"):
+        counts = Product.facet_counts()
+    products, priced, total = counts["all"][0][1:] if counts["all"] else (0, 0, 0)
+    available = {value: count for value, count, _, _ in counts["available"]}
+    return facets_response({
+        "products": products,
+        "available": available.get("true", 0),
+        "unavailable": available.get("false", 0),
+        "average_price": round(total / priced, 2) if priced else None,
+        "categories": len(counts["category"]),
+        "colors": len(counts["color"]),
+        "sizes": len(counts["size"]),
+    })
+
+######################################################################
+# SEARCH PRODUCTS
+######################################################################
+@api.route("/products/search", methods=["GET"])
+def search_products():
+    """
+    Search the Products
+
+    Matches the words of q against the name, description and category,
+    tolerating typos in the name on Postgres, and returns the best matches
+    first with their score. Pages are SEARCH_PAGE_SIZE long by default.
+    """
+    text = request.args.get("q", "")
+    current_app.logger.info("Request to search products for: %s", text)
+    limit, offset = get_page_args()
+    limit = limit or current_app.config["SEARCH_PAGE_SIZE"]
+    offset = offset or 0
+    stmt = Product.select_search(text, limit, offset)
+    with timed_phase("orm"):
+        rows = Product.fetch_rows(stmt)
+    with timed_phase("serialize"):
+        results = encoding.rows_to_dicts(stmt.c.keys(), rows)
+    mimetype = body_mimetype()
+    with timed_phase("jsonify"):
+        body = encoding.dumps(results, mimetype)
+    response = make_response(body, status.HTTP_200_OK, {"Content-Type": mimetype})
+    response.vary.add("Accept")
+    if len(rows) == limit:
+        # ranked results have no stable key, so the cursor is the offset
+        add_next_page_headers(response, offset + limit)
+    return response
+
+######################################################################
+# LIST CHANGES
+######################################################################
+@api.route("/products/changes", methods=["GET"])
+def list_changes():
+    """
+    Returns the products changed or deleted since a change token
+
+    Changes come in version order, and a product changed many times only
+    once, at its last version. The response carries the token to ask for
+    the following changes with, also when there were none, so consumers can
+    keep polling with it. Without since it starts from the whole catalog.
+    With wait, a poll that finds no changes waits up to that many seconds
+    for the next commit before answering.
+    """
+    since = request.args.get("since")
+    current_app.logger.info("Request for changes since: %s", since)
+    since = decode_change_token(since) if since else (0, 0)
+    limit, _ = get_page_args()
+    limit = limit or current_app.config["CHANGES_PAGE_SIZE"]
+    wait = get_wait_arg()
+    bus = current_app.extensions["events"]
+    # subscribed before reading, so a commit in between still wakes the poll
+    subscription = bus.subscribe() if wait else None
+    try:
+        with timed_phase("orm"):
+            changes = Product.changes(since, limit)
+        if not changes and subscription is not None:
+            db.session.close()  # hold no connection while waiting
+            if subscription.get(wait) is not None:
+                read_from_primary()  # the replicas may not have the change yet
+                with timed_phase("orm"):
+                    changes = Product.changes(since, limit)
+    finally:
+        if subscription is not None:
+            bus.unsubscribe(subscription)
+    with timed_phase("serialize"):
+        results = []
+        for version, product_id, product in changes:
+            change = {"id": product_id, "version": version, "deleted": product is None}
+            if product is not None:
+                change["product"] = product.serialize()
+            results.append(change)
+    last = changes[-1][:2] if changes else since
+    mimetype = body_mimetype()
+    with timed_phase("jsonify"):
+        body = encoding.dumps(
+            {"changes": results, "next": encode_change_token(*last), "more": len(changes) == limit},
+            mimetype,
+        )
+    response = make_response(body, status.HTTP_200_OK, {"Content-Type": mimetype})
+    response.vary.add("Accept")
+    return response
+
+######################################################################
+# STREAM PRODUCT EVENTS
+######################################################################
+@api.route("/products/events", methods=["GET"])
+def stream_events():
+    """
+    Streams the product events as server-sent events
+
+    Every event is named after its op (create, update, delete or restock)
+    and has the change token of the product as its id. The events are read
+    from the change feed, in its order, and a committed event only wakes
+    the stream up, so a client that reconnects with Last-Event-ID (or
+    since) misses nothing: it first gets what it missed, as update and
+    delete events, then the live events, named after their op when it
+    arrived before they were read from the feed. The feed is also read every
+    EVENTS_HEARTBEAT_SECONDS, when a comment is sent, and the stream ends
+    after EVENTS_STREAM_SECONDS or when the client falls too far behind,
+    so it reconnects.
+    """
+    since = request.headers.get("Last-Event-ID") or request.args.get("since")
+    current_app.logger.info("Request for events since: %s", since)
+    since = decode_change_token(since) if since else None
+    config = current_app.config
+    bus = current_app.extensions["events"]
+    subscription = bus.subscribe()
+    read_from_primary()  # a lagging replica would skip the changes before the subscription
+    # subscribed first, so what commits after the head wakes the stream
+    head = since or Product.change_head()
+    db.session.close()
+
+    def generate():
+        try:
+            yield ": connected\n\n"
+            sent = head
+            ops = {}  # the ops of the live events, by (version, id)
+            deadline = time.monotonic() + config["EVENTS_STREAM_SECONDS"]
+            while True:
+                batch = subscription.get(0)
+                while batch is not None:
+                    ops.update(((event["version"], event["id"]), event["op"]) for event in batch)
+                    batch = subscription.get(0)
+                while True:
+                    changes = Product.changes(sent, config["CHANGES_PAGE_SIZE"])
+                    for version, product_id, product in changes:
+                        op = ops.get((version, product_id), "update")
+                        if product is None or op == "delete":
+                            op = "delete" if product is None else "update"
+                        yield server_sent_event(op, product_id, version)
+                        sent = (version, product_id)
+                    if len(changes) < config["CHANGES_PAGE_SIZE"]:
+                        break
+                db.session.close()  # hold no connection while waiting
+                ops = {key: op for key, op in ops.items() if key > sent}
+                if subscription.overflowed or time.monotonic() >= deadline:
+                    break
+                timeout = min(config["EVENTS_HEARTBEAT_SECONDS"], deadline - time.monotonic())
+                batch = subscription.get(max(timeout, 0))
+                if batch is None:
+                    yield ": keepalive\n\n"
+                else:
+                    ops.update(((event["version"], event["id"]), event["op"]) for event in batch)
+        finally:
+            bus.unsubscribe(subscription)
+
+    response = Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx must pass the events on at once
+    return response
 
 ######################################################################
 # RETRIEVE A PRODUCT
 ######################################################################
-@app.route("/products/<int:product_id>", methods=["GET"])
+@api.route("/products/<int:product_id>", methods=["GET"])
 def get_products(product_id):
     """
     Retrieve a single Product
 
     This endpoint will return a product based on it's id
     """
-    app.logger.info("Request for product with id: %s", product_id)
-    product = Product.find(product_id)
+    current_app.logger.info("Request for product with id: %s", product_id)
+    product = Product.find_serialized(product_id)
     if not product:
         raise NotFound(
             "Product with id '{}' was not found.".format(product_id)
         )
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    etag = product_etag(product, body_mimetype())
+    if etag in request.if_none_match:
+        response = make_response("", status.HTTP_304_NOT_MODIFIED, {"ETag": quote_etag(etag)})
+        response.vary.add("Accept")
+        return response
+    return product_response(product, etag)
+
+######################################################################
+# PRODUCT CACHE STATISTICS
+######################################################################
+@api.route("/products/cache", methods=["GET"])
+def get_cache_stats():
+    """ Returns the hit and miss counters of the product read cache """
+    return make_response(jsonify(Product.cache.stats()), status.HTTP_200_OK)
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@api.route("/metrics", methods=["GET"])
+def get_metrics():
+    """ Returns the request, database and serialization metrics """
+    body, content_type = render_metrics()
+    return make_response(body, status.HTTP_200_OK, {"Content-Type": content_type})
+
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+@api.route("/products/pool", methods=["GET"])
+def get_pool_stats():
+    """ Returns the in use, overflow and checkout wait gauges of the pool """
+    stats = pool_stats(db.engine.pool)
+    replicas = current_app.extensions.get("replicas")
+    if replicas:
+        stats["replicas"] = [
+            dict(replica, **pool_stats(engine.pool))
+            for replica, engine in zip(replicas.stats(), replicas.engines)
+        ]
+    return make_response(jsonify(stats), status.HTTP_200_OK)
 
 ######################################################################
 # CREATE A NEW PRODUCT
 ######################################################################
-@app.route("/products", methods=["POST"])
+@api.route("/products", methods=["POST"])
 def create_product():
     """
     Creates a Product
     This endpoint will create a Product based on the data in the body that is posted
     """
-    app.logger.info("Request to create a product")
+    current_app.logger.info("Request to create a product")
     check_content_type("application/json")
     product = Product()
     product.deserialize(request.get_json())
     product.create()
     message = product.serialize()
-    location_url = url_for("get_products", product_id=product.id, _external=True)
+    location_url = url_for(".get_products", product_id=product.id, _external=True)
     #location_url = "not yet implemented - story #7"
     return make_response(
         jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
@@ -101,68 +508,500 @@ def create_product():
 ######################################################################
 # UPDATE AN EXISTING PRODUCT
 ######################################################################
-@app.route("/products/<int:product_id>", methods=["PUT"])
+@api.route("/products/<int:product_id>", methods=["PUT"])
 def update_product(product_id):
     """
     Update an existing product
     This endpoint will update a Product based on the body that is posted
     """
-    app.logger.info("Request to update product with id: %s", product_id)
+    current_app.logger.info("Request to update product with id: %s", product_id)
     stock = request.args.get("stock")
-    product = Product.find(product_id)
+    product = Product.find(product_id, lock=bool(request.if_match))
     if not product:
+        check_if_match(None)
         raise NotFound(
             "Product with id '{}' was not found.".format(product_id)
         )
-    elif stock:
+    check_if_match(product)
+    if stock:
         product.restock(stock)
         product.save()
-        return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
-       
+        return product_response(product.serialize())
+
     check_content_type("application/json")
     product.deserialize(request.get_json())
     product.id = product_id
     product.save()
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    return product_response(product.serialize())
+
+######################################################################
+# PATCH AN EXISTING PRODUCT
+######################################################################
+@api.route("/products/<int:product_id>", methods=["PATCH"])
+def patch_product(product_id):
+    """
+    Change some fields of an existing product
+
+    The body is a JSON Merge Patch: only the fields it names are changed,
+    null clears a field, and the product is not read before the update
+    unless If-Match asks to check it
+    """
+    current_app.logger.info("Request to patch product with id: %s", product_id)
+    check_content_type(MERGE_PATCH, "application/json")
+    changes = request.get_json()
+    if request.if_match:
+        check_if_match(Product.find(product_id, lock=True))
+    product = Product.patch(product_id, changes)
+    if not product:
+        raise NotFound(
+            "Product with id '{}' was not found.".format(product_id)
+        )
+    return product_response(product)
 
 ######################################################################
 # DELETE A PRODUCT
 ######################################################################
-@app.route("/products/<int:product_id>", methods=["DELETE"])
+@api.route("/products/<int:product_id>", methods=["DELETE"])
 def delete_products(product_id):
     """
     Delete a Product
     This endpoint will delete a Product based the id specified in the path
     """
-    app.logger.info("Request to delete product with id: %s", product_id)
-    product = Product.find(product_id)
+    current_app.logger.info("Request to delete product with id: %s", product_id)
+    product = Product.find(product_id, lock=bool(request.if_match))
+    check_if_match(product)
     if product:
         product.delete()
 
-    app.logger.info("Product with ID [%s] delete complete.", product_id)
+    current_app.logger.info("Product with ID [%s] delete complete.", product_id)
     return make_response("", status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# ATOMIC STOCK OPERATIONS
+######################################################################
+@api.route("/products/<int:product_id>/stock", methods=["POST"])
+def adjust_product_stock(product_id):
+    """
+    Adjust the stock of a Product
+    This endpoint takes {"delta": n} to add n (or remove -n) units, or
+    {"stock": n} to set the stock, as a single UPDATE without a read first
+    """
+    current_app.logger.info("Request to adjust stock of product with id: %s", product_id)
+    check_content_type("application/json")
+    data = request.get_json()
+    if isinstance(data, dict) and "stock" in data:
+        quantity = get_int(data, "stock")
+        if quantity < 0:
+            raise DataValidationError("Invalid stock: must not be negative")
+        stock = Product.set_stock(product_id, quantity)
+    else:
+        stock = Product.adjust_stock(product_id, get_int(data, "delta"))
+    if stock is None:
+        stock_failure(product_id)
+    return make_response(jsonify(id=product_id, stock=stock), status.HTTP_200_OK)
+
+@api.route("/products/stock", methods=["POST"])
+def adjust_products_stock():
+    """
+    Adjust the stock of many Products at once
+    This endpoint takes [{"id": i, "delta": n}, ...] and applies every
+    delta in one transaction, or none of them if any product is short
+    """
+    current_app.logger.info("Request to adjust stock of many products")
+    check_content_type("application/json")
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise DataValidationError("Stock adjustments must be a JSON array")
+    deltas = {}
+    for item in items:
+        product_id = get_int(item, "id")
+        deltas[product_id] = deltas.get(product_id, 0) + get_int(item, "delta")
+    stocks, failed = Product.adjust_stock_many(deltas)
+    if failed is not None:
+        stock_failure(failed)
+    results = [{"id": product_id, "stock": stock} for product_id, stock in stocks.items()]
+    return make_response(jsonify(results), status.HTTP_200_OK)
+
+######################################################################
+# BULK CREATE, UPDATE AND DELETE PRODUCTS
+######################################################################
+@api.route("/products/bulk", methods=["POST"])
+def create_products_bulk():
+    """
+    Creates many Products
+    This endpoint takes a JSON array (or NDJSON stream) of products and
+    inserts them in batches, reporting the outcome of every item; one whose
+    SKU is taken fails with 409 while the others are still created
+    """
+    current_app.logger.info("Request to bulk create products")
+    results, products = [], []
+    for index, item in enumerate(get_bulk_items()):
+        try:
+            products.append((index, Product().deserialize(item)))
+        except DataValidationError as error:
+            results.append(bulk_error(index, error))
+    conflicts = set(Product.create_many(
+        [product for _, product in products], current_app.config["BULK_BATCH_SIZE"]
+    ))
+    for index, product in products:
+        if product in conflicts:
+            results.append(bulk_conflict(index, product))
+        else:
+            results.append({"index": index, "status": status.HTTP_201_CREATED, "id": product.id})
+    return bulk_response(results, "created")
+
+@api.route("/products/bulk", methods=["PUT"])
+def update_products_bulk():
+    """
+    Updates many Products
+    This endpoint takes a JSON array (or NDJSON stream) of products that
+    each carry their id and updates them in batches
+    """
+    current_app.logger.info("Request to bulk update products")
+    results, products = [], []
+    for index, item in enumerate(get_bulk_items()):
+        try:
+            product = Product().deserialize(item)
+            product.id = get_bulk_id(item.get("id"))
+            products.append((index, product))
+        except DataValidationError as error:
+            results.append(bulk_error(index, error))
+    updated, conflicts = Product.update_many(
+        [product for _, product in products], current_app.config["BULK_BATCH_SIZE"]
+    )
+    conflicts = set(conflicts)
+    for index, product in products:
+        if product in conflicts:
+            results.append(bulk_conflict(index, product))
+        elif product.id in updated:
+            results.append({"index": index, "status": status.HTTP_200_OK, "id": product.id})
+        else:
+            results.append(bulk_not_found(index, product.id))
+    return bulk_response(results, "updated")
+
+@api.route("/products/bulk", methods=["DELETE"])
+def delete_products_bulk():
+    """
+    Deletes many Products
+    This endpoint takes a JSON array (or NDJSON stream) of product ids and
+    deletes them in batches
+    """
+    current_app.logger.info("Request to bulk delete products")
+    results, ids = [], []
+    for index, item in enumerate(get_bulk_items()):
+        try:
+            ids.append((index, get_bulk_id(item)))
+        except DataValidationError as error:
+            results.append(bulk_error(index, error))
+    deleted = Product.delete_many(
+        [product_id for _, product_id in ids], current_app.config["BULK_BATCH_SIZE"]
+    )
+    for index, product_id in ids:
+        if product_id in deleted:
+            results.append({"index": index, "status": status.HTTP_204_NO_CONTENT, "id": product_id})
+        else:
+            results.append(bulk_not_found(index, product_id))
+    return bulk_response(results, "deleted")
+
 ######################################################################
 # DELETE ALL PET DATA (for testing only)
 ######################################################################
-@app.route('/products/reset', methods=['DELETE'])
+@api.route('/products/reset', methods=['DELETE'])
 def products_reset():
     """ Removes all products from the database """
     Product.remove_all()
+    db.session.commit()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
-def init_db():
+def init_app(app):
+    """ Adds the routes, request hooks and database of the service to an app """
+    app.register_blueprint(api)
+    init_metrics(app)
+    init_profiling(app)
+    init_replicas(app)
+    init_compression(app)  # last, so the other hooks see the compressed body
+    init_db(app)
+
+def init_db(app=None):
     """ Initialies the SQLAlchemy app """
-    global app
-    Product.init_db(app)
+    Product.init_db(app or current_app._get_current_object())
+
+@api.cli.command("create-schema")
+def create_schema():
+    """ Creates the missing tables and indexes """
+    Product.create_schema()
+
+@api.cli.command("rebuild-facets")
+def rebuild_facets():
+    """ Recounts the product facets from the products """
+    Product.rebuild_facets()
+    db.session.commit()
+
+def product_etag(data, mimetype=encoding.JSON):
+    """ Computes the strong ETag of a serialized product in a body format """
+    key = data if mimetype == encoding.JSON else [mimetype, data]
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def list_etag(version, limit, mimetype):
+    """ Computes the strong ETag of a page from the page_version of its products """
+    key = [request.path, sorted(request.args.items(multi=True)), limit, mimetype, list(version)]
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+def product_response(data, etag=None):
+    """ Returns a serialized product with its ETag """
+    mimetype = body_mimetype()
+    with timed_phase("jsonify"):
+        if mimetype == encoding.MSGPACK:
+            response = make_response(
+                encoding.dumps(data, mimetype), status.HTTP_200_OK, {"Content-Type": mimetype}
+            )
+        else:
+            response = make_response(jsonify(data), status.HTTP_200_OK)
+    response.vary.add("Accept")
+    response.set_etag(etag or product_etag(data, mimetype))
+    return response
+
+def check_if_match(product):
+    """ Aborts with 412 unless the product matches the If-Match header """
+    if not request.if_match:
+        return
+    if product is None or not any(
+        product_etag(product.serialize(), mimetype) in request.if_match
+        for mimetype in encoding.mimetypes()
+    ):
+        db.session.rollback()  # release the row lock
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            "Product has changed since it was read; fetch it again and retry",
+        )
+
+def split_args(name):
+    """ Splits a comma separated query string argument into a list """
+    value = request.args.get(name)
+    if not value:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def wants_stream():
+    """ Checks if the client asked for a newline delimited JSON stream """
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON])
+    return best == NDJSON
+
+def body_mimetype():
+    """ Returns the body format the client prefers, JSON unless it asks for MessagePack """
+    return request.accept_mimetypes.best_match(encoding.mimetypes(), encoding.JSON)
+
+def stream_products(stmt):
+    """ Streams the product rows of a SELECT as newline delimited JSON
+
+    Clients that accept MessagePack get a stream of MessagePack maps instead
+    """
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+    names = stmt.c.keys()
+    mimetype = NDJSON
+    if request.accept_mimetypes.best_match([NDJSON] + encoding.mimetypes()) == encoding.MSGPACK:
+        mimetype = encoding.MSGPACK
+
+    def generate():
+        for row in Product.stream_rows(stmt, batch_size):
+            if mimetype == NDJSON:
+                yield encoding.dumps(dict(zip(names, row))) + b"\n"
+            else:
+                yield encoding.dumps(dict(zip(names, row)), mimetype)
+
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype=mimetype)
+
+def lookup_response(key, values):
+    """ Returns the products for a list of ids or SKUs in the order asked for """
+    limit = current_app.config["LOOKUP_MAX_ITEMS"]
+    if len(values) > limit:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "At most {} {} can be looked up at once".format(limit, key),
+        )
+    batch_size = current_app.config["LOOKUP_BATCH_SIZE"]
+    with timed_phase("orm"):
+        if key == "ids":
+            found = Product.find_many_serialized(values, batch_size)
+        else:
+            found = Product.find_many_by_sku(values, batch_size)
+    mimetype = body_mimetype()
+    with timed_phase("jsonify"):
+        body = encoding.dumps({
+            "products": [found.get(value) for value in values],
+            "missing": [value for value in values if value not in found],
+        }, mimetype)
+    response = make_response(body, status.HTTP_200_OK, {"Content-Type": mimetype})
+    response.vary.add("Accept")
+    return response
+
+def facet_value(facet, value):
+    """ Converts a counted facet value back to its JSON value """
+    if value == "":
+        return None
+    if facet == "available":
+        return value == "true"
+    return value
+
+def facets_response(data):
+    """ Returns facets or statistics with an ETag """
+    mimetype = body_mimetype()
+    with timed_phase("jsonify"):
+        body = encoding.dumps(data, mimetype)
+    response = make_response(body, status.HTTP_200_OK, {"Content-Type": mimetype})
+    response.vary.add("Accept")
+    response.add_etag()
+    return response.make_conditional(request)
+
+def get_wait_arg():
+    """ Parses the seconds a long poll may wait for changes """
+    wait = request.args.get("wait")
+    if wait is None:
+        return 0
+    try:
+        wait = float(wait)
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "wait must be a number of seconds")
+    if not wait >= 0:
+        abort(status.HTTP_400_BAD_REQUEST, "wait must not be negative")
+    return min(wait, current_app.config["LONG_POLL_MAX_SECONDS"])
+
+def server_sent_event(op, product_id, version):
+    """ Formats a product event as a server-sent event """
+    data = json.dumps({"op": op, "id": product_id, "version": version})
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        encode_change_token(version, product_id), op, data
+    )
+
+def get_page_args():
+    """ Parses the limit and after cursor of a paginated list request """
+    limit = request.args.get("limit")
+    after = request.args.get("after")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be an integer")
+        if limit < 1:
+            abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer")
+        limit = min(limit, current_app.config["PAGE_SIZE_MAX"])
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after
+
+def encode_cursor(product_id):
+    """ Encodes the id of the last product in a page as an opaque cursor """
+    return base64.urlsafe_b64encode(str(product_id).encode()).decode()
+
+def decode_cursor(cursor):
+    """ Decodes an opaque cursor back into a product id """
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid cursor: {}".format(cursor))
+
+def encode_change_token(version, product_id):
+    """ Encodes the version and id of the last change seen as an opaque token """
+    return encode_cursor("{}.{}".format(version, product_id))
+
+def decode_change_token(token):
+    """ Decodes a change token back into a (version, id) tuple """
+    try:
+        version, product_id = base64.urlsafe_b64decode(token.encode()).decode().split(".")
+        return int(version), int(product_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(status.HTTP_400_BAD_REQUEST, "Invalid change token: {}".format(token))
+
+def add_next_page_headers(response, last_id):
+    """ Adds the Link and X-Next-Cursor headers that point to the next page """
+    cursor = encode_cursor(last_id)
+    args = request.args.to_dict()
+    args["after"] = cursor
+    next_url = url_for(request.endpoint, _external=True, **args)
+    response.headers["Link"] = '<{}>; rel="next"'.format(next_url)
+    response.headers["X-Next-Cursor"] = cursor
+
+def get_int(data, key):
+    """ Returns an integer field of a JSON object or raises DataValidationError """
+    value = data.get(key) if isinstance(data, dict) else None
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise DataValidationError("Invalid request: {} must be an integer".format(key))
+    return value
+
+def stock_failure(product_id):
+    """ Raises 404 for a missing product, or 409 for one short of stock """
+    if Product.find(product_id) is None:
+        raise NotFound("Product with id '{}' was not found.".format(product_id))
+    abort(
+        status.HTTP_409_CONFLICT,
+        "Product with id '{}' does not have enough stock.".format(product_id),
+    )
+
+def get_bulk_items():
+    """ Reads the items of a bulk request from a JSON array or an NDJSON stream """
+    if request.headers.get("Content-Type") == NDJSON:
+        items = []
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)  # reported as invalid with its index
+        return items
+    check_content_type("application/json")
+    items = request.get_json()
+    if not isinstance(items, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Bulk requests must send a JSON array")
+    return items
+
+def get_bulk_id(value):
+    """ Validates a product id given in a bulk request """
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise DataValidationError("Invalid Product: id must be an integer")
+    return value
+
+def bulk_error(index, error):
+    """ Builds the result of a bulk item that failed validation """
+    return {"index": index, "status": status.HTTP_400_BAD_REQUEST, "error": str(error)}
+
+def bulk_not_found(index, product_id):
+    """ Builds the result of a bulk item whose product does not exist """
+    return {
+        "index": index,
+        "status": status.HTTP_404_NOT_FOUND,
+        "id": product_id,
+        "error": "Product with id '{}' was not found.".format(product_id),
+    }
+
+def bulk_conflict(index, product):
+    """ Builds the result of a bulk item whose SKU another product already has """
+    result = {
+        "index": index,
+        "status": status.HTTP_409_CONFLICT,
+        "error": "Product with SKU '{}' already exists.".format(product.sku),
+    }
+    if product.id is not None:
+        result["id"] = product.id
+    return result
+
+def bulk_response(results, action):
+    """ Returns the per item results of a bulk request and their summary """
+    results.sort(key=lambda result: result["index"])
+    succeeded = sum(1 for result in results if "error" not in result)
+    summary = {action: succeeded, "failed": len(results) - succeeded}
+    current_app.logger.info("Bulk request complete: %s", summary)
+    return make_response(jsonify(results=results, summary=summary), status.HTTP_200_OK)
 
-def check_content_type(content_type):
-    """ Checks that the media type is correct """
-    if request.headers["Content-Type"] == content_type:
+def check_content_type(*content_types):
+    """ Checks that the media type is one of the given ones """
+    if request.headers.get("Content-Type") in content_types:
         return
-    app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
-    abort(415, "Content-Type must be {}".format(content_type))
\ No newline at end of file
+    current_app.logger.error("Invalid Content-Type: %s", request.headers.get("Content-Type"))
+    abort(415, "Content-Type must be {}".format(" or ".join(content_types)))
\ No newline at end of file
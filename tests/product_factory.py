@@ -22,7 +22,7 @@ class ProductFactory(factory.Factory):
     size = FuzzyChoice(choices=["L", "M", "S"])
     color = FuzzyChoice(choices=["blue", "yellow", "red"])
     category = FuzzyChoice(choices=["paper", "electronics", "food"])
-    sku = "00000000"
+    sku = factory.Sequence(lambda n: "{:08d}".format(n))
     description = "test description"
 
 if __name__ == "__main__":
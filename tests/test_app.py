@@ -0,0 +1,100 @@
+"""
+Test cases for the app factory
+
+Each test creates its own app on a fresh SQLite file to see when the
+schema gets created.
+"""
+import os
+import logging
+import tempfile
+import unittest
+from sqlalchemy import inspect
+from service import create_app
+from service.models import db
+
+
+######################################################################
+#  A P P   F A C T O R Y   T E S T   C A S E S
+######################################################################
+class TestAppFactory(unittest.TestCase):
+    """ Test Cases for create_app() and DB_SCHEMA """
+
+    def setUp(self):
+        """ Runs before each test """
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _create_app(self, schema):
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + self.path,
+            "DB_SCHEMA": schema,
+            "TESTING": True,
+        })
+        app.logger.setLevel(logging.CRITICAL)
+        return app
+
+    def _tables(self, app):
+        with app.app_context():
+            tables = inspect(db.engine).get_table_names()
+            db.session.remove()
+            return tables
+
+    def test_eager_schema(self):
+        """ Create the tables with the app """
+        app = self._create_app("eager")
+        self.assertIn("product", self._tables(app))
+
+    def test_lazy_schema(self):
+        """ Create the tables before the first request only """
+        app = self._create_app("lazy")
+        self.assertEqual(self._tables(app), [])
+        with app.app_context():
+            resp = app.test_client().get("/products")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), [])
+            db.session.remove()
+        self.assertIn("product", self._tables(app))
+
+    def test_skip_schema(self):
+        """ Leave creating the tables to the create-schema command """
+        app = self._create_app("skip")
+        self.assertEqual(app.before_first_request_funcs, [])
+        self.assertEqual(self._tables(app), [])
+        result = app.test_cli_runner().invoke(args=["products", "create-schema"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("product", self._tables(app))
+
+    def test_schema_with_replicas(self):
+        """ Create the schema on the primary only when replicas are configured """
+        handle, replica = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        self.addCleanup(os.remove, replica)
+        for schema in ("eager", "lazy"):
+            app = create_app({
+                "SQLALCHEMY_DATABASE_URI": "sqlite:///" + self.path,
+                "DATABASE_REPLICA_URIS": ["sqlite:///" + replica],
+                "DB_SCHEMA": schema,
+                "TESTING": True,
+            })
+            app.logger.setLevel(logging.CRITICAL)
+            with app.app_context():
+                resp = app.test_client().post("/products", json={
+                    "name": "pen", "sku": schema, "available": True, "price": 1.5,
+                    "stock": 1, "size": "S", "color": "red", "category": "office",
+                    "description": "",
+                })
+                self.assertEqual(resp.status_code, 201)
+                db.session.remove()
+            self.assertIn("product", self._tables(app))
+            self.assertEqual(inspect(db.get_engine(app, bind="replica0")).get_table_names(), [])
+
+    def test_apps_are_independent(self):
+        """ Create a new app with its own settings on every call """
+        first, second = self._create_app("skip"), self._create_app("skip")
+        self.assertIsNot(first, second)
+        self.assertIn("products.list_products", first.view_functions)
+        second.config["PAGE_SIZE_MAX"] = 1
+        self.assertNotEqual(first.config["PAGE_SIZE_MAX"], 1)
@@ -0,0 +1,181 @@
+"""
+Test cases for the Product caches
+
+"""
+import os
+import time
+import fnmatch
+import tempfile
+import unittest
+from service.cache import LRUCache, FileCache, RedisCache, make_cache
+
+
+class FakeRedis:
+    """ A local stand-in for the few redis-py calls the cache makes """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, 0))
+        return value if expires > time.time() else None
+
+    def set(self, key, value, px=None):
+        self.data[key] = (value.encode(), time.time() + px / 1000.0)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match="*"):
+        return [key for key in list(self.data) if fnmatch.fnmatch(key, match)]
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        return []
+
+
+######################################################################
+#  L R U   C A C H E   T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the in-process LRU cache """
+
+    def test_get_and_set(self):
+        """ Cache a value and count hits and misses """
+        cache = LRUCache(size=2, ttl=60)
+        self.assertIsNone(cache.get(1))
+        cache.set(1, {"id": 1})
+        self.assertEqual(cache.get(1), {"id": 1})
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 1, 1))
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the least recently used entry when full """
+        cache = LRUCache(size=2, ttl=60)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), "one")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expires_entries(self):
+        """ Expire entries after their ttl """
+        cache = LRUCache(size=2, ttl=0.01)
+        cache.set(1, "one")
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_delete_and_clear(self):
+        """ Invalidate single entries or the whole cache """
+        cache = LRUCache()
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.set(3, "three")
+        cache.delete(1, 4)
+        self.assertIsNone(cache.get(1))
+        cache.clear()
+        self.assertIsNone(cache.get(2))
+
+    def test_get_and_set_many(self):
+        """ Read and write many entries at once """
+        cache = LRUCache(size=10, ttl=60)
+        cache.set_many({1: "one", 2: "two"})
+        self.assertEqual(cache.get_many([1, 2, 3]), {1: "one", 2: "two"})
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+    def test_disabled(self):
+        """ Never cache anything with a size of 0 """
+        cache = LRUCache(size=0)
+        cache.set(1, "one")
+        self.assertIsNone(cache.get(1))
+
+
+######################################################################
+#  S H A R E D   C A C H E   T E S T   C A S E S
+######################################################################
+class TestSharedCaches(unittest.TestCase):
+    """ Test Cases for the caches shared between workers """
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+
+    def tearDown(self):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_file_cache_is_shared(self):
+        """ See writes and invalidations of another worker in the file cache """
+        worker1 = FileCache(self.path, ttl=60)
+        worker2 = FileCache(self.path, ttl=60)
+        worker1.set(1, {"id": 1, "name": "shirt"})
+        self.assertEqual(worker2.get(1), {"id": 1, "name": "shirt"})
+        worker2.delete(1)
+        self.assertIsNone(worker1.get(1))
+        worker1.set(2, {"id": 2})
+        worker2.clear()
+        self.assertEqual(worker1.count(), 0)
+
+    def test_file_cache_expires_and_evicts(self):
+        """ Expire and evict entries of the file cache """
+        cache = FileCache(self.path, size=5, ttl=0.05)
+        cache.set(1, "one")
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(1))
+        cache.ttl = 60
+        # the expired entry was the first set, so this prunes on the last one
+        for key in range(FileCache.PRUNE_EVERY - 1):
+            cache.set(key, key)
+        self.assertEqual(cache.count(), 5)
+        self.assertEqual(cache.get(FileCache.PRUNE_EVERY - 2), FileCache.PRUNE_EVERY - 2)
+
+    def test_file_cache_many(self):
+        """ Read and write many entries of the file cache at once """
+        cache = FileCache(self.path, ttl=60)
+        cache.BATCH_SIZE = 2
+        cache.set_many({key: {"id": key} for key in range(5)})
+        self.assertEqual(cache.get_many([4, 0, 9, 2]), {4: {"id": 4}, 0: {"id": 0}, 2: {"id": 2}})
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_redis_cache(self):
+        """ Share entries through a Redis server """
+        server = FakeRedis()
+        worker1 = RedisCache(client=server, ttl=60)
+        worker2 = RedisCache(client=server, ttl=60)
+        worker1.set(1, {"id": 1})
+        self.assertEqual(worker2.get(1), {"id": 1})
+        self.assertEqual(worker2.stats()["hits"], 1)
+        server.set("other:1", "untouched", px=60000)
+        worker2.delete(1)
+        self.assertIsNone(worker1.get(1))
+        worker1.set(2, {"id": 2})
+        worker1.clear()
+        self.assertEqual(worker2.count(), 0)
+        self.assertIsNotNone(server.get("other:1"))
+        worker1.set_many({3: {"id": 3}, 4: {"id": 4}})
+        self.assertEqual(worker2.get_many([3, 5, 4]), {3: {"id": 3}, 4: {"id": 4}})
+        self.assertEqual(worker2.get_many([]), {})
+
+    def test_make_cache(self):
+        """ Create the backend named in the config """
+        config = {
+            "CACHE_SIZE": 10, "CACHE_TTL": 1, "CACHE_PATH": self.path,
+            "CACHE_REDIS_URL": "redis://localhost:6379/0",
+        }
+        config["CACHE_BACKEND"] = "memory"
+        self.assertIsInstance(make_cache(config), LRUCache)
+        config["CACHE_BACKEND"] = "file"
+        self.assertIsInstance(make_cache(config), FileCache)
+        config["CACHE_BACKEND"] = "memcached"
+        self.assertRaises(ValueError, make_cache, config)
@@ -0,0 +1,29 @@
+"""
+Test cases for the JSON encoding of responses
+
+"""
+import json
+import unittest
+from unittest.mock import patch
+from service import encoding
+
+
+######################################################################
+#  E N C O D I N G   T E S T   C A S E S
+######################################################################
+class TestEncoding(unittest.TestCase):
+    """ Test Cases for the fast JSON encoder """
+
+    def test_rows_to_json(self):
+        """ Encode rows as a JSON list of objects """
+        rows = [(1, "shirt", 9.99, True), (2, None, 0.5, False)]
+        data = encoding.rows_to_dicts(["id", "name", "price", "available"], rows)
+        self.assertEqual(json.loads(encoding.dumps(data)), [
+            {"id": 1, "name": "shirt", "price": 9.99, "available": True},
+            {"id": 2, "name": None, "price": 0.5, "available": False},
+        ])
+
+    def test_stdlib_fallback(self):
+        """ Encode with the json module when orjson is missing """
+        with patch.object(encoding, "orjson", None):
+            self.assertEqual(encoding.dumps({"id": 1, "tags": []}), b'{"id":1,"tags":[]}')
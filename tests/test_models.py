@@ -6,9 +6,12 @@ import logging
 import unittest
 import os
 import json
+from unittest.mock import patch
 from service.models import Product, DataValidationError, db
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import NotFound
-from service import app
+from service import app, encoding
 from .product_factory import ProductFactory
 
 DATABASE_URI = os.getenv(
@@ -103,6 +106,27 @@ class TestProducts(unittest.TestCase):
         products = Product.all()
         self.assertEqual(len(products), 1)
 
+    def test_sku_is_unique(self):
+        """ Refuse a second Product with the same SKU """
+        product = ProductFactory(sku="12345678")
+        product.create()
+        duplicate = ProductFactory(sku="12345678")
+        self.assertRaises(IntegrityError, duplicate.create)
+        db.session.rollback()
+
+    def test_create_missing_indexes(self):
+        """ Create the declared indexes on an existing table """
+        def index_names():
+            return {index["name"] for index in inspect(db.engine).get_indexes("product")}
+
+        declared = {index.name for index in Product.__table__.indexes}
+        self.assertEqual(index_names(), declared)
+        db.engine.execute("DROP INDEX ix_product_category_available")
+        db.engine.execute("DROP INDEX ix_product_sku")
+        self.assertNotIn("ix_product_sku", index_names())
+        Product.create_missing_indexes()
+        self.assertEqual(index_names(), declared)
+
 ######################################################################
 # P U T  T E S T   C A S E S
 ######################################################################
@@ -149,6 +173,124 @@ class TestProducts(unittest.TestCase):
         self.assertEqual(products[0].stock, 100)
         self.assertEqual(products[0].available, True)
 
+    def test_adjust_stock(self):
+        """ Adjust the stock of a Product without going negative """
+        product = ProductFactory(stock=5, available=False)
+        product.create()
+        self.assertEqual(Product.adjust_stock(product.id, -3), 2)
+        self.assertIsNone(Product.adjust_stock(product.id, -3))
+        self.assertEqual(Product.adjust_stock(product.id, 10), 12)
+        self.assertIsNone(Product.adjust_stock(0, 1))
+        product = Product.find(product.id)
+        self.assertEqual(product.stock, 12)
+        self.assertEqual(product.available, True)
+        self.assertEqual(Product.set_stock(product.id, 0), 0)
+        self.assertIsNone(Product.set_stock(0, 1))
+
+    def test_adjust_stock_many(self):
+        """ Adjust the stock of several Products all or nothing """
+        products = [ProductFactory(stock=5), ProductFactory(stock=1)]
+        for product in products:
+            product.create()
+        stocks, failed = Product.adjust_stock_many({1: -2, 2: -1})
+        self.assertEqual((stocks, failed), ({1: 3, 2: 0}, None))
+        stocks, failed = Product.adjust_stock_many({1: -2, 2: -1})
+        self.assertEqual((stocks, failed), ({}, 2))
+        self.assertEqual(Product.find(1).stock, 3)
+
+######################################################################
+# B U L K  T E S T   C A S E S
+######################################################################
+
+    def test_create_many_products(self):
+        """ Create Products in batches """
+        products = ProductFactory.create_batch(5)
+        Product.create_many(products, batch_size=2)
+        self.assertEqual([p.id for p in products], [1, 2, 3, 4, 5])
+        self.assertEqual(len(Product.all()), 5)
+
+    def test_create_many_duplicate_skus(self):
+        """ Skip the Products whose SKU is taken and create the others """
+        stored = ProductFactory()
+        stored.create()
+        products = ProductFactory.build_batch(4)
+        products[1].sku = stored.sku
+        products[3].sku = products[2].sku
+        conflicts = Product.create_many(products, batch_size=2)
+        self.assertEqual(conflicts, [products[1], products[3]])
+        self.assertEqual([p.id for p in products], [2, None, 3, None])
+        self.assertEqual(len(Product.all()), 3)
+
+    def test_create_many_concurrent_sku(self):
+        """ Check the SKUs again when another writer took one meanwhile """
+        stored = ProductFactory()
+        stored.create()
+        product = ProductFactory(sku=stored.sku)
+        with patch.object(Product, "_taken_skus", side_effect=[[], [product]]):
+            self.assertEqual(Product.create_many([product]), [product])
+        self.assertIsNone(product.id)
+        self.assertEqual(len(Product.all()), 1)
+
+    def test_update_many_duplicate_skus(self):
+        """ Skip the Products given a SKU another one has and update the others """
+        products = ProductFactory.build_batch(3)
+        Product.create_many(products)
+        skus = [product.sku for product in products]
+        products[0].sku = skus[1]
+        products[1].name = "renamed"
+        products[2].sku = "new-sku"
+        again = ProductFactory(id=products[2].id, sku="new-sku")
+        updated, conflicts = Product.update_many(products + [again], batch_size=2)
+        self.assertEqual(updated, {2, 3})
+        self.assertEqual(conflicts, [products[0]])
+        db.session.expunge_all()
+        self.assertEqual(Product.find(1).sku, skus[0])
+        self.assertEqual(Product.find(2).name, "renamed")
+        self.assertEqual(Product.find(3).sku, "new-sku")
+
+    def test_patch_a_product(self):
+        """ Change only the patched fields of a Product """
+        product = ProductFactory()
+        product.create()
+        original = product.serialize()
+        data = Product.patch(original["id"], {"price": 3, "description": None})
+        db.session.expunge_all()
+        stored = Product.find(original["id"])
+        self.assertEqual(data, stored.serialize())
+        self.assertEqual((stored.price, stored.description), (3, None))
+        self.assertEqual((stored.name, stored.sku), (original["name"], original["sku"]))
+        self.assertGreater(stored.version, original["version"])
+        self.assertIsNone(Product.patch(0, {"price": 3}))
+        # an empty patch is a no-op
+        self.assertEqual(Product.patch(original["id"], {}), data)
+        self.assertEqual(Product.find(original["id"]).version, data["version"])
+        self.assertIsNone(Product.patch(0, {}))
+
+    def test_patch_validation(self):
+        """ Reject patches with unknown fields or values of the wrong type """
+        for changes in ([], "price", {"id": 7}, {"version": 1}, {"price": "3"}, {"price": True},
+                        {"stock": 1.5}, {"available": "yes"}, {"size": "XXXXL"}, {"name": 5}):
+            self.assertRaises(DataValidationError, Product.validate_patch, changes)
+        self.assertEqual(
+            Product.validate_patch({"price": 2, "stock": 0, "available": False, "color": None}),
+            {"price": 2, "stock": 0, "available": False, "color": None},
+        )
+        self.assertEqual(Product.validate_patch({}), {})
+
+    def test_update_and_delete_many_products(self):
+        """ Update and delete Products in batches """
+        products = ProductFactory.create_batch(3)
+        Product.create_many(products)
+        for product in products:
+            product.category = "bulk"
+        missing = ProductFactory(id=99)
+        updated, conflicts = Product.update_many(products + [missing], batch_size=2)
+        self.assertEqual((updated, conflicts), ({1, 2, 3}, []))
+        self.assertEqual(Product.find_by_category("bulk").count(), 3)
+        deleted = Product.delete_many([1, 3, 99], batch_size=2)
+        self.assertEqual(deleted, {1, 3})
+        self.assertEqual([p.id for p in Product.all()], [2])
+
 ######################################################################
 # G E T  T E S T   C A S E S
 ######################################################################
@@ -173,6 +315,32 @@ class TestProducts(unittest.TestCase):
         self.assertEqual(test_product.color, products[1].color)
         self.assertEqual(test_product.category, products[1].category)
 
+    def test_find_many_serialized(self):
+        """ Find many Products by ID through the cache """
+        products = ProductFactory.create_batch(5)
+        for product in products:
+            product.create()
+        ids = [product.id for product in products]
+        Product.cache.clear()
+        Product.cache.set(ids[0], {"id": ids[0], "cached": True})
+        found = Product.find_many_serialized([ids[3], 0, ids[0], ids[1], ids[3]], batch_size=2)
+        self.assertEqual(set(found), {ids[0], ids[1], ids[3]})
+        self.assertEqual(found[ids[0]], {"id": ids[0], "cached": True})
+        self.assertEqual(found[ids[3]], products[3].serialize())
+        # the misses were cached for the next lookup
+        self.assertEqual(Product.cache.get(ids[1]), products[1].serialize())
+
+    def test_find_many_by_sku(self):
+        """ Find many Products by SKU """
+        products = ProductFactory.create_batch(3)
+        for product in products:
+            product.create()
+        skus = [products[2].sku, "no-such-sku", products[0].sku]
+        found = Product.find_many_by_sku(skus, batch_size=1)
+        self.assertEqual(set(found), {products[0].sku, products[2].sku})
+        self.assertEqual(found[products[2].sku], products[2].serialize())
+        self.assertEqual(Product.cache.get(products[0].id), products[0].serialize())
+
     def test_find_by_category(self):
         """ Find Products by Category """
         products = ProductFactory.create_batch(3)
@@ -195,6 +363,84 @@ class TestProducts(unittest.TestCase):
         self.assertIsNot(test_products[0].name, "KEVIN")
         self.assertEqual(test_products[0].id, products[0].id)
 
+    def test_paginate_products(self):
+        """ Page through Products by id """
+        products = ProductFactory.create_batch(5)
+        for product in products:
+            product.create()
+        page = Product.all(limit=2)
+        self.assertEqual([p.id for p in page], [1, 2])
+        page = Product.all(limit=2, after=page[-1].id)
+        self.assertEqual([p.id for p in page], [3, 4])
+        page = Product.all(limit=2, after=page[-1].id)
+        self.assertEqual([p.id for p in page], [5])
+        category = products[0].category
+        matches = [p.id for p in products if p.category == category]
+        page = Product.find_by_category(category, limit=1, after=matches[0])
+        self.assertEqual([p.id for p in page], matches[1:2])
+
+    def test_find_by_query(self):
+        """ Find Products by several filters at once """
+        products = ProductFactory.create_batch(10)
+        for product in products:
+            product.create()
+        color = products[0].color
+        found = Product.find_by_query({"color": color, "stock_min": "20"}, sort=["-stock"])
+        expected = sorted(
+            (p for p in products if p.color == color and p.stock >= 20),
+            key=lambda p: (-p.stock, p.id),
+        )
+        self.assertEqual([p.id for p in found], [p.id for p in expected])
+        rows = Product.find_by_query(fields=["name"], limit=3).all()
+        self.assertEqual([row._asdict() for row in rows],
+                         [{"id": p.id, "name": p.name} for p in products[:3]])
+        self.assertRaises(DataValidationError, Product.find_by_query, {"weight": "1"})
+
+    def test_select_rows(self):
+        """ Read Product rows without the ORM """
+        products = ProductFactory.create_batch(5)
+        Product.create_many(products)
+        color = products[0].color
+        stmt = Product.select_rows({"color": color}, fields=["name", "color"], limit=2)
+        self.assertEqual(stmt.c.keys(), ["id", "name", "color"])
+        expected = [(p.id, p.name, p.color) for p in products if p.color == color][:2]
+        self.assertEqual(Product.fetch_rows(stmt), expected)
+        stmt = Product.select_rows(after=2)
+        rows = list(Product.stream_rows(stmt, batch_size=2))
+        self.assertEqual([row[0] for row in rows], [3, 4, 5])
+        # rows hold datetimes, which encode to the strings serialize() returns
+        row = json.loads(encoding.dumps(dict(zip(stmt.c.keys(), rows[0]))))
+        self.assertEqual(row, products[2].serialize())
+
+    def test_select_search_postgres(self):
+        """ Search Postgres with full text and trigram matching """
+        from sqlalchemy.dialects import postgresql
+        Product.fuzzy_search = True
+        try:
+            stmt = Product.select_search("shrit", limit=5, dialect="postgresql")
+        finally:
+            Product.fuzzy_search = False
+        sql = str(stmt.compile(dialect=postgresql.dialect()))
+        self.assertIn("@@ plainto_tsquery", sql)
+        self.assertIn("similarity(product.name", sql)
+        self.assertIn("ORDER BY score DESC", sql)
+
+    def test_fuzzy_search_detection(self):
+        """ Look pg_trgm up in the database, whoever created the schema """
+        Product.fuzzy_search = None
+        try:
+            self.assertFalse(Product.has_fuzzy_search())
+            Product.fuzzy_search = None
+            with patch.object(db.engine.dialect, "name", "postgresql"), \
+                    patch.object(db.session, "execute") as execute:
+                execute.return_value.scalar.return_value = 1
+                self.assertTrue(Product.has_fuzzy_search())
+                self.assertTrue(Product.has_fuzzy_search())
+            self.assertEqual(execute.call_count, 1)
+            self.assertIn("pg_extension", str(execute.call_args[0][0]))
+        finally:
+            Product.fuzzy_search = False
+
     def test_find_or_404_found(self):
         """ Find or return 404 found """
         products = ProductFactory.create_batch(3)
@@ -208,4 +454,177 @@ class TestProducts(unittest.TestCase):
 
     def test_find_or_404_not_found(self):
         """ Find or return 404 NOT found """
-        self.assertRaises(NotFound, Product.find_or_404, 0)
\ No newline at end of file
+        self.assertRaises(NotFound, Product.find_or_404, 0)
+######################################################################
+# C H A N G E   F E E D   T E S T   C A S E S
+######################################################################
+
+    def test_versions(self):
+        """ Stamp every write with a new catalog version """
+        product = ProductFactory()
+        product.create()
+        created = product.version
+        self.assertGreater(created, 0)
+        self.assertIsNotNone(product.updated_at)
+        product.name = "renamed"
+        product.save()
+        self.assertGreater(product.version, created)
+        saved = product.version
+        product.restock(20)
+        product.save()
+        self.assertGreater(product.version, saved)
+        Product.adjust_stock(product.id, -1)
+        Product.set_stock(product.id, 5)
+        db.session.expire_all()
+        self.assertEqual(product.version, saved + 3)
+
+    def test_postgres_versions(self):
+        """ Take the transaction id as the version on Postgres, without a lock """
+        with patch.object(db.engine.dialect, "name", "postgresql"), \
+                patch.object(db.session, "execute") as execute:
+            execute.return_value.scalar.return_value = 4242
+            self.assertEqual(Product.next_version(), 4242)
+            self.assertEqual(Product.next_version(), 4242)
+        execute.assert_called_once_with("SELECT txid_current()")
+        db.session.rollback()
+        self.assertNotIn("catalog_version", db.session.info)
+
+    def test_bulk_versions(self):
+        """ Stamp a bulk batch with one version """
+        products = ProductFactory.build_batch(3)
+        Product.create_many(products)
+        self.assertEqual({product.version for product in products}, {products[0].version})
+        for product in products:
+            product.name = "renamed"
+        Product.update_many(products)
+        db.session.expire_all()
+        versions = {product.version for product in Product.all()}
+        self.assertEqual(versions, {products[0].version + 1})
+
+    def test_changes(self):
+        """ Return the changes after a point in version order """
+        products = ProductFactory.build_batch(3)
+        for product in products:
+            product.create()
+        self.assertEqual([change[1] for change in Product.changes()],
+                         [product.id for product in products])
+        since = (products[0].version, products[0].id)
+        products[0].name = "renamed"
+        products[0].save()
+        products[1].delete()
+        changes = Product.changes(since)
+        self.assertEqual([(change[1], change[2] is None) for change in changes],
+                         [(products[2].id, False), (products[0].id, False), (products[1].id, True)])
+        # paging picks up after the last change seen
+        first = Product.changes(since, limit=1)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(Product.changes(first[0][:2]), changes[1:])
+
+    def test_bulk_delete_tombstones(self):
+        """ Record a tombstone for every deleted product """
+        products = ProductFactory.build_batch(4)
+        Product.create_many(products)
+        Product.delete_many([products[0].id, products[1].id])
+        since = (products[0].version, products[-1].id)
+        deleted = [change[1] for change in Product.changes(since) if change[2] is None]
+        self.assertEqual(deleted, [products[0].id, products[1].id])
+        Product.remove_all()
+        db.session.commit()
+        deleted = [change[1] for change in Product.changes(since) if change[2] is None]
+        self.assertEqual(sorted(deleted), [product.id for product in products])
+
+    def test_create_missing_columns(self):
+        """ Add the declared columns to an existing table """
+        db.drop_all()
+        db.engine.execute("CREATE TABLE product (id INTEGER PRIMARY KEY, name VARCHAR(63))")
+        db.engine.execute("INSERT INTO product (name) VALUES ('old')")
+        Product.create_missing_columns()
+        columns = {column["name"] for column in inspect(db.engine).get_columns("product")}
+        self.assertEqual(columns, {column.name for column in Product.__table__.columns})
+        self.assertEqual(Product.all()[0].version, 0)
+
+######################################################################
+# F A C E T   T E S T   C A S E S
+######################################################################
+    def _facets(self):
+        """ Returns the facet counts with rounded price totals """
+        return {
+            facet: {value: (count, round(total, 6)) for value, count, _, total in values}
+            for facet, values in Product.facet_counts().items()
+        }
+
+    def test_facets_follow_writes(self):
+        """ Keep the facet counts up to date on every kind of write """
+        products = ProductFactory.build_batch(6)
+        for product in products:
+            product.available = True
+            product.price = 12.5
+        Product.create_many(products[:3])
+        for product in products[3:]:
+            product.create()
+        facets = self._facets()
+        self.assertEqual(facets["all"], {"": (6, 75.0)})
+        self.assertEqual(facets["available"], {"true": (6, 75.0)})
+        self.assertEqual(facets["price"], {"12": (6, 75.0)})
+        products[3].price = 99.99
+        products[3].category = "brand new"
+        products[3].save()
+        products[4].delete()
+        Product.delete_many([products[0].id])
+        products[1].available = False
+        Product.update_many([products[1]])
+        facets = self._facets()
+        self.assertEqual(facets["all"], {"": (4, 137.49)})
+        self.assertEqual(facets["category"]["brand new"], (1, 99.99))
+        self.assertEqual(facets["available"], {"true": (3, 124.99), "false": (1, 12.5)})
+        self.assertEqual(facets["price"], {"12": (3, 37.5), "99": (1, 99.99)})
+        Product.set_stock(products[1].id, 5)
+        facets = self._facets()
+        self.assertEqual(facets["available"], {"true": (4, 137.49)})
+        # the triggers counted exactly what a full recount finds
+        Product.rebuild_facets()
+        self.assertEqual(self._facets(), facets)
+        Product.remove_all()
+        db.session.commit()
+        self.assertEqual(Product.facet_counts()["all"], [])
+
+    def test_facets_without_price(self):
+        """ Count the Products without a price apart from the priced ones """
+        products = ProductFactory.build_batch(2)
+        for product, price in zip(products, (10.0, None)):
+            product.category = "pens"
+            product.price = price
+        Product.create_many(products)
+        counted = Product.facet_counts()["category"]
+        self.assertEqual(counted, [("pens", 2, 1, 10.0)])
+        products[1].price = 4.0
+        Product.update_many(products[1:])
+        self.assertEqual(Product.facet_counts()["category"], [("pens", 2, 2, 14.0)])
+        Product.rebuild_facets()
+        self.assertEqual(Product.facet_counts()["category"], [("pens", 2, 2, 14.0)])
+
+    def test_facets_migration(self):
+        """ Recount the facets of a table made before priced was counted """
+        Product.create_many(ProductFactory.build_batch(3))
+        counted = Product.facet_counts()
+        db.session.commit()
+        db.engine.execute("DROP TABLE product_facet")
+        db.engine.execute(
+            "CREATE TABLE product_facet (facet VARCHAR(16), value VARCHAR(63), count BIGINT "
+            "NOT NULL, price_total FLOAT NOT NULL, PRIMARY KEY (facet, value))"
+        )
+        db.create_all()
+        self.assertEqual(Product.facet_counts(), counted)
+        Product.create_many(ProductFactory.build_batch(1))
+        self.assertEqual(Product.facet_counts()["all"][0][1:3], (4, 4))
+
+    def test_rebuild_facets(self):
+        """ Count the products of a database made before the facets """
+        products = ProductFactory.build_batch(5)
+        Product.create_many(products)
+        counted = self._facets()
+        db.session.execute("DELETE FROM product_facet")
+        self.assertEqual(Product.facet_counts()["all"], [])
+        Product.rebuild_facets()
+        db.session.commit()
+        self.assertEqual(self._facets(), counted)